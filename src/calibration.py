@@ -0,0 +1,336 @@
+# +
+import numpy as np
+import itertools
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib import pyplot as plt
+
+from src import config as cfg
+from src import computation as comp
+from src import data_io as io
+from src import plotting
+
+
+# Calibration from joint histograms instead of per pixel arrays.
+# For every pair of channels (i, j) we count how many pixels had value x in channel i and value y in channel j.
+# That is all reduce_to_means, get_unmixing_ratio, compute_PMT_nonlinearity and the spread plot need, it can be built
+# one chunk of planes at a time, and its size only depends on cfg.calibration_max_value, not on the stack.
+
+
+def get_channel_pairs(num_channels):
+    return list(itertools.combinations(range(num_channels), 2))
+
+
+def get_ordered_channel_pairs(num_channels):
+    #every (i, j) with i != j. Each order is calibrated, the ratio and PMT curve of (i, j) are for channel i against j
+    return list(itertools.permutations(range(num_channels), 2))
+
+
+def new_pair_histograms(num_channels, max_value=None):
+    if max_value is None:
+        max_value = cfg.calibration_max_value
+    return {pair: np.zeros((max_value, max_value), dtype=np.int64) for pair in get_channel_pairs(num_channels)}
+
+
+def accumulate_pair_histograms(chunk, histograms):
+    #add the pixels of a channel-last chunk (any number of leading axes) to the histograms, in place
+    #values are clipped to the histogram range, so saturated/very bright pixels all land in the last bin
+    #(see count_clipped to warn about it)
+    num_bins = next(iter(histograms.values())).shape[0]
+    pixels_x_channels = chunk.reshape(-1, chunk.shape[-1])
+    values = [np.clip(pixels_x_channels[:, channel], 0, num_bins - 1).astype(np.intp)
+              for channel in range(chunk.shape[-1])]
+    for (i, j), histogram in histograms.items():
+        # one bincount per pair on the flat index x*num_bins + y
+        flat = np.bincount(values[i] * num_bins + values[j], minlength=num_bins * num_bins)
+        histogram += flat.reshape(num_bins, num_bins)
+    return histograms
+
+
+def count_clipped(chunk, num_bins):
+    #how many values accumulate_pair_histograms puts in the last bin although they are brighter
+    return int(np.count_nonzero(chunk >= num_bins))
+
+
+def warn_if_clipped(clipped, num_bins, source):
+    if clipped:
+        logging.warning(f'{clipped} pixel values of {source} are above {num_bins - 1} and were counted in the last '
+                        f'histogram bin, raise cfg.calibration_max_value to keep them apart')
+
+
+def get_stack_histograms(fullpath, num_channels=None, planes_per_chunk=1, max_value=None):
+    #one streaming pass over the stack (every timepoint), only planes_per_chunk planes are in memory at a time
+    if num_channels is None:
+        num_channels = cfg.num_channels
+    if max_value is None:
+        max_value = cfg.calibration_max_value
+    histograms = None
+    clipped = 0
+    for chunk in io.iter_stack_chunks(fullpath, planes_per_chunk, num_channels):
+        if histograms is None:
+            histograms = new_pair_histograms(chunk.shape[-1], max_value)
+        accumulate_pair_histograms(chunk, histograms)
+        clipped += count_clipped(chunk, max_value)
+    warn_if_clipped(clipped, max_value, fullpath)
+    return histograms
+
+
+def get_pair_histogram(histograms, i, j):
+    #only i < j is stored, the other order is the transpose
+    if (i, j) in histograms:
+        return histograms[(i, j)]
+    return histograms[(j, i)].T
+
+
+def group_histogram_by_x(histogram):
+    #same as comp.group_by_x(chanX, chanY) for the pixels counted in the histogram (x on the first axis)
+    counts = histogram.sum(axis=1)
+    present = np.flatnonzero(counts)
+    histogram = histogram[present]
+    counts = counts[present]
+    ys = np.arange(histogram.shape[1])
+    means = histogram @ ys / counts
+    variances = histogram @ (ys**2) / counts - means**2
+    # the E[y^2] - E[y]^2 form is fine here, counts are exact and values are small
+    return present, counts, means, np.maximum(variances, 0)
+
+
+def reduce_histogram_to_means(histogram):
+    ordered_xs, _, mean_ys, _ = group_histogram_by_x(histogram)
+    return ordered_xs, mean_ys
+
+
+def get_pair_ratio(histogram):
+    #smoothed means (as in main.main_scatter_only) and the unmixing ratio, channel i per channel j
+    ordered_is, mean_js = reduce_histogram_to_means(histogram)
+    mean_js = comp.smooth(mean_js, 5)
+    xs, ys, xs_per_y = comp.get_unmixing_ratio(ordered_is, mean_js)
+    return ordered_is, mean_js, xs_per_y
+
+
+def calibrate_pair(histogram, name=''):
+    #the same steps as main.main for one pair of channels: means, smoothed, then the unmixing ratio and the PMT curve
+    #None when there is no valid ratio at all, and 'counts' and 'corrections' are None (with a warning) when only
+    #the PMT curve fails
+    try:
+        ordered_is, mean_js, xs_per_y = get_pair_ratio(histogram)
+    except ValueError:
+        return None
+    result = {'ordered_xs': ordered_is, 'mean_ys': mean_js, 'xs_per_y': xs_per_y, 'counts': None, 'corrections': None}
+    try:
+        result['counts'], result['corrections'] = comp.compute_PMT_nonlinearity(ordered_is, mean_js, xs_per_y)
+    except ValueError as E:
+        logging.warning(f'No PMT curve from {name}: {E}')
+    return result
+
+
+def get_spreads(histogram):
+    #for plotting.plot_spread_from_histogram: the distribution of y around its mean for bands of x values
+    #returns a list of (x, bin_edges, density), using the same config settings as plotting.plot_spread
+    bins = np.arange(-cfg.spread_limit, cfg.spread_limit, cfg.spread_bin_size) - 0.5
+    xs_present = np.flatnonzero(histogram.sum(axis=1))
+    ys = np.arange(histogram.shape[1])
+    spreads = []
+    if len(xs_present) == 0:
+        return spreads
+    for x in np.arange(cfg.min_lin_val, xs_present[-1], cfg.spread_interval):
+        low = max(int(np.ceil(x - cfg.combine_counts)), 0)
+        high = int(np.floor(x + cfg.combine_counts)) + 1
+        y_counts = histogram[low:high].sum(axis=0)
+        total = y_counts.sum()
+        if total > 20:
+            mean = y_counts @ ys / total
+            density, _ = np.histogram(ys - mean, bins=bins, weights=y_counts, density=True)
+            spreads.append((x, bins, density))
+    return spreads
+
+
+class CalibrationState:
+    """Pair histograms of every control acquisition of one flourophore added so far.
+
+    Add stacks (or chunks) as they are acquired, save the state and load it in a later session, merge states built
+    elsewhere, and call finalize whenever coefficients and PMT curves are needed. Nothing but the histograms is kept,
+    so adding an acquisition never means reading the earlier ones again.
+    """
+    def __init__(self, num_channels=None, fp="", max_value=None):
+        if num_channels is None:
+            num_channels = cfg.num_channels
+        self.num_channels = num_channels
+        self.fp = fp
+        self.histograms = new_pair_histograms(num_channels, max_value)
+        self.sources = []  # stacks added so far, so the same one isn't counted twice
+
+    @property
+    def max_value(self):
+        return next(iter(self.histograms.values())).shape[0]
+
+    def add_chunk(self, chunk):
+        accumulate_pair_histograms(chunk, self.histograms)
+        warn_if_clipped(count_clipped(chunk, self.max_value), self.max_value, 'the chunk')
+
+    def add_stack(self, fullpath, planes_per_chunk=1):
+        source = os.path.abspath(fullpath)
+        if source in self.sources:
+            logging.warning(f'{fullpath} has already been added to the calibration, skipping it')
+            return self
+        clipped = 0
+        for chunk in io.iter_stack_chunks(fullpath, planes_per_chunk, self.num_channels):
+            accumulate_pair_histograms(chunk, self.histograms)
+            clipped += count_clipped(chunk, self.max_value)
+        warn_if_clipped(clipped, self.max_value, fullpath)
+        self.sources.append(source)
+        return self
+
+    def merge(self, other):
+        #add the counts of another state (in place)
+        if (other.num_channels, other.max_value) != (self.num_channels, self.max_value):
+            raise (ValueError(f"Can't merge calibrations with {other.num_channels} channels and {other.max_value} bins into "
+                              f"one with {self.num_channels} channels and {self.max_value} bins"))
+        if other.fp != self.fp:
+            raise (ValueError(f"Can't merge calibrations of different flourophores ({other.fp} and {self.fp})"))
+        shared = set(other.sources) & set(self.sources)
+        if shared:
+            raise (ValueError(f"Both calibrations already contain {sorted(shared)}"))
+        for pair, histogram in other.histograms.items():
+            self.histograms[pair] += histogram
+        self.sources.extend(other.sources)
+        return self
+
+    def save(self, path):
+        pairs = list(self.histograms)
+        np.savez_compressed(path, pairs=np.array(pairs), histograms=np.array([self.histograms[pair] for pair in pairs]),
+                            num_channels=self.num_channels, fp=self.fp, sources=np.array(self.sources, dtype=str))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            state = cls(int(data['num_channels']), fp=str(data['fp']), max_value=data['histograms'].shape[-1])
+            state.histograms = {tuple(int(c) for c in pair): histogram
+                                for pair, histogram in zip(data['pairs'], data['histograms'])}
+            state.sources = [str(source) for source in data['sources']]
+        return state
+
+    def get_reference_channel(self):
+        #the brightest channel on average. Every channel's pixel counts are a margin of the pair histograms
+        values = np.arange(self.max_value)
+        channel_means = np.zeros(self.num_channels)
+        for (i, j), histogram in self.histograms.items():
+            channel_means[i] = histogram.sum(axis=1) @ values
+            channel_means[j] = histogram.sum(axis=0) @ values
+        return int(np.argmax(channel_means))
+
+    def finalize(self, save_curves=False):
+        """Unmixing coefficients (summing to 1) and a PMT curve for each pair of channels from everything added so far.
+
+        The coefficients come from the ratio of every channel to the brightest one, and are all NaN (with a warning) when
+        a channel doesn't have enough points to compare. Pairs are every (i, j) with i != j, as in calibrate_images, and
+        those without enough points in the linear range for a curve are left out with a warning. save_curves writes the
+        curves with io.save_PMT_curve.
+        """
+        pairs = {(i, j): calibrate_pair(get_pair_histogram(self.histograms, i, j), f'channels {i}{j} of {self.fp}')
+                 for i, j in get_ordered_channel_pairs(self.num_channels)}
+        coefficients = get_pair_coefficients(self.get_reference_channel(), pairs, self.num_channels, self.fp)
+        curves = {(i, j): (result['counts'], result['corrections']) for (i, j), result in pairs.items()
+                  if result is not None and result['counts'] is not None}
+        if save_curves:
+            for (i, j), (counts, corrections) in curves.items():
+                io.save_PMT_curve(counts, corrections, i=i, j=j, fp=self.fp)
+        return coefficients, curves
+
+
+def get_coefficients(reference, reference_per_channel, num_channels):
+    #coefficients summing to 1 from the unmixing ratio (reference channel per channel) of every other channel
+    ratios = np.ones(num_channels)
+    for channel, xs_per_y in reference_per_channel.items():
+        ratios[channel] = 1 / xs_per_y
+    return ratios / np.sum(ratios)
+
+
+def get_pair_coefficients(reference, pairs, num_channels, fp):
+    #coefficients from the calibrate_pair results of one flourophore ({(i, j): result}), used by both
+    #CalibrationState.finalize and calibrate_images. NaN with a warning when a channel can't be compared to the reference
+    reference_per_channel = {j: pairs[(reference, j)]['xs_per_y'] for j in range(num_channels)
+                             if j != reference and pairs.get((reference, j)) is not None}
+    if len(reference_per_channel) < num_channels - 1:
+        logging.warning(f'Not enough valid points to compare every channel to channel {reference} for {fp}')
+        return np.full(num_channels, np.nan)
+    return get_coefficients(reference, reference_per_channel, num_channels)
+
+
+def calibrate_images(image_paths, fps=None, num_workers=1, planes_per_chunk=1, save_curves=False, num_channels=None):
+    """Calibrate from every control image at once, spread over num_workers processes.
+
+    Each image is read once and reduced to its pair histograms (one job per image), images of the same flourophore are
+    merged, and then every (flourophore, channel i, channel j) pair is a job of its own. fps gives the flourophore of
+    each image, by default taken from the file names. num_channels is needed for I16 folders (cfg.num_channels by
+    default), tiffs know their own. Figures are a separate step, see save_calibration_figures.
+    Returns a dict with
+    'coefficients': {fp: coefficients}, ready to use as UnmixingSession.unmixing_coefficient_dict
+    'pairs': {(fp, i, j): calibrate_pair result, or None when there weren't enough valid points}
+    'states': {fp: CalibrationState}, which can be saved and added to later
+    """
+    if fps is None:
+        fps = [comp.fp_from_tiffname(os.path.basename(path)) for path in image_paths]
+    if num_channels is None:
+        num_channels = cfg.num_channels
+    states = _map(_image_state, [(path, fp, planes_per_chunk, num_channels) for path, fp in zip(image_paths, fps)],
+                  num_workers)
+    merged = {}
+    for state in states:
+        if state.fp in merged:
+            merged[state.fp].merge(state)
+        else:
+            merged[state.fp] = state
+
+    jobs = [(fp, i, j) for fp, state in merged.items() for i, j in get_ordered_channel_pairs(state.num_channels)]
+    pair_jobs = ((get_pair_histogram(merged[fp].histograms, i, j), f'channels {i}{j} of {fp}') for fp, i, j in jobs)
+    pairs = dict(zip(jobs, _map(_calibrate_pair_job, pair_jobs, num_workers)))
+
+    coefficients = {}
+    for fp, state in merged.items():
+        fp_pairs = {(i, j): result for (fp_, i, j), result in pairs.items() if fp_ == fp}
+        coefficients[fp] = get_pair_coefficients(state.get_reference_channel(), fp_pairs, state.num_channels, fp)
+
+    if save_curves:
+        for (fp, i, j), result in pairs.items():
+            if result is not None and result['counts'] is not None:
+                io.save_PMT_curve(result['counts'], result['corrections'], i=i, j=j, fp=fp)
+    return {'coefficients': coefficients, 'pairs': pairs, 'states': merged}
+
+
+def save_calibration_figures(calibration):
+    #the figures main.main makes, for every pair in the output of calibrate_images
+    for (fp, i, j), result in calibration['pairs'].items():
+        if result is None:
+            continue
+        fig, ax, title = plotting.plot_channels(result['ordered_xs'], result['mean_ys'], i, j, alpha=1, label=fp,
+                                                color="r", plot=False)
+        io.savefig(fig, title)
+        plt.close(fig)
+        if result['counts'] is not None:
+            fig, ax = plotting.plot_pmt_nonlinearity(result['corrections'], result['counts'], plot=False)
+            io.savefig(fig, f"PMT curve from {fp} on {i}{j}")
+            plt.close(fig)
+        histogram = get_pair_histogram(calibration['states'][fp].histograms, i, j)
+        fig, ax, title = plotting.plot_spread_from_histogram(get_spreads(histogram), i, j, plot=False)
+        io.savefig(fig, f"spread_{j}_for_{fp}")
+        plt.close(fig)
+
+
+def _map(function, items, num_workers):
+    if num_workers == 1:
+        return list(map(function, items))
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        return list(executor.map(function, items))
+
+
+def _image_state(job):
+    path, fp, planes_per_chunk, num_channels = job
+    num_channels = io.get_stack_shape(path, num_channels)[-1]
+    return CalibrationState(num_channels, fp).add_stack(path, planes_per_chunk)
+
+
+def _calibrate_pair_job(job):
+    histogram, name = job
+    return calibrate_pair(histogram, name)
@@ -4,9 +4,17 @@ import os
 import glob
 import numpy as np
 import logging
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 from scipy.optimize import nnls
 import scipy.ndimage
 
+#optional, only used to compile the fused kernel (fused_unmix). Everything works without it
+try:
+    import numba
+except ImportError:
+    numba = None
+
 
 from src import config as cfg
 from src import data_io as io
@@ -41,63 +49,202 @@ def reverse_fake_pmt(detected_photons):
 
 
 def fake_pmt_n(photons_array, round=True):
-    y = []
-    x = []
-    for actual_photons in photons_array:
-        if round:
-            y.append(np.round(fake_pmt(actual_photons)))
-        else:
-            y.append(fake_pmt(actual_photons))
-        x.append(reverse_fake_pmt(y[-1]))
-    return np.array(x), np.array(y)
+    y = fake_pmt_array(photons_array)
+    if round:
+        y = np.round(y)
+    x = reverse_fake_pmt_array(y)
+    return x, y
+
+
+def fake_pmt_array(actual_photons, shot_noise=False, rng=None):
+    #fake_pmt for a whole array at once. With shot_noise the photons reaching the PMT are first drawn from a poisson
+    #distribution around actual_photons
+    actual_photons = np.asarray(actual_photons, dtype=np.float64)
+    if shot_noise:
+        rng = np.random.default_rng(rng)
+        actual_photons = rng.poisson(actual_photons).astype(np.float64)
+    detected = actual_photons / (1 + (actual_photons - 15) ** 2 / (300 - 15) ** 2)
+    np.putmask(detected, actual_photons < 15, actual_photons)
+    np.putmask(detected, actual_photons >= 300, 150)
+    return detected
+
+
+def reverse_fake_pmt_array(detected_photons):
+    #reverse_fake_pmt for a whole array at once
+    detected_photons = np.asarray(detected_photons, dtype=np.float64)
+    actual = detected_photons * (1 + (detected_photons - 15) ** 2 / (150 - 15) ** 2)
+    np.putmask(actual, detected_photons < 15, detected_photons)
+    np.putmask(actual, detected_photons >= 150, 300)
+    return actual
+
+
+def make_synthetic_stack(shape, unmixing_mat, mean_photons=50, foreground_fraction=0.5, shot_noise=True,
+                         dtype=np.uint16, seed=None):
+    """Simulate a ZYXC stack through the fake PMT, with the ground truth it was made from.
+
+    shape is ZYX and unmixing_mat is channels x flourophores, as passed to unmix. Each foreground pixel gets an
+    exponentially distributed amount of every flourophore (so the bright tail saturates), background pixels get none.
+    Returns the detected stack (ZYXC, rounded to dtype), the true flourophore amounts (ZYXN) and the true photons per
+    channel before the PMT (ZYXC)."""
+    rng = np.random.default_rng(seed)
+    unmixing_mat = np.asarray(unmixing_mat, dtype=np.float64)
+    num_channels, num_flourophores = unmixing_mat.shape
+    detected = np.empty(tuple(shape) + (num_channels,), dtype=dtype)
+    flourophores = np.empty(tuple(shape) + (num_flourophores,), dtype=np.float32)
+    true_photons = np.empty(tuple(shape) + (num_channels,), dtype=np.float32)
+    #one plane at a time to keep the float64 temporaries small
+    for z in range(shape[0]):
+        amounts = rng.exponential(mean_photons, size=tuple(shape[1:]) + (num_flourophores,))
+        amounts *= rng.random(tuple(shape[1:]) + (1,)) < foreground_fraction
+        photons = amounts @ unmixing_mat.T
+        flourophores[z] = amounts
+        true_photons[z] = photons
+        detected[z] = np.round(fake_pmt_array(photons, shot_noise=shot_noise, rng=rng))
+    return detected, flourophores, true_photons
 
 
 def get_valid_pairs(xs_in, ys_in, override_bounds=False):
-    xs = []
-    ys = []
     # loop through until you hit nonlinearity. Compute what linear should be
-    # lets choose valid range from config
-    for x in xs_in[np.logical_and(xs_in > cfg.min_lin_val, xs_in < cfg.max_lin_val)]:
-        y = np.mean(ys_in[xs_in == x])
-        # is there a possibility that this will be unbalanced depending on which is X and which is Y?
-        if (
-            ((y <= cfg.max_lin_val) and (y >= cfg.min_lin_val)) or (override_bounds)
-        ) and not (np.isnan(y)):
-            # we want to normalize the vector to put them all on the same playing field
-            length = np.linalg.norm(np.array([x, y]))
-            xs.append(x / length)
-            ys.append(y / length)
-    return xs, ys
-
-
-def get_unmixing_coefs(im_array):
-    #identify the axis for color channel
-    channel_axis = im_1.shape.index(cfg.num_channels)
-
-    #whats the numpy way to do this? we don't really care if this is fast, but I want to practice thinking this way...
-    #mask out all the invalidvalid values
-
-    #maybe we should flaten it first? to just 2 dimensions? channel and value
-
-    #find the channel with the highes max/most variance
-
-    #what if we actually did the division first, then there are no new masks
-
-    #then create new masks I think you have to loop here?
-    #No - create an array of all the desired inputs (make sure they are all present in the looping axis
-
-    #pull out the masked values and then average
-
-    #we should now have an array that is channels by X values
-    #we divide it by the x value (including the one that has said x values)
-
-    #then take the mean across the values axis
-
-
-    #im = np.rollaxis(im, channel_axis)
-    #for
-    return coefs_arrray
-
+    # lets choose valid range from config. Each x value is only counted once, however many pixels have it
+    unique_xs, _, mean_ys, _ = group_by_x(xs_in, ys_in)
+    in_range = np.logical_and(unique_xs > cfg.min_lin_val, unique_xs < cfg.max_lin_val)
+    xs = unique_xs[in_range]
+    ys = mean_ys[in_range]
+    # is there a possibility that this will be unbalanced depending on which is X and which is Y?
+    valid = ~np.isnan(ys)
+    if not override_bounds:
+        valid &= (ys <= cfg.max_lin_val) & (ys >= cfg.min_lin_val)
+    xs = xs[valid]
+    ys = ys[valid]
+    # we want to normalize the vector to put them all on the same playing field
+    length = np.hypot(xs, ys)
+    return list(xs / length), list(ys / length)
+
+
+def get_unmixing_coefs(im_array, linearized=False, method='mean', trim=0.1, channel_axis=-1):
+    """Unmixing coefficients (one per channel, summing to 1) of the single flourophore imaged in im_array.
+
+    The brightest channel is the reference. Pixels are grouped by their reference value inside the linear window
+    (min_lin_val to max_lin_val for raw images, range_min to range_max for linearized ones), each channel is averaged
+    per group and divided by the reference value, and the ratios are combined over the groups so each value counts once.
+    method is how they are combined: 'mean', 'median' or 'trimmed_mean' (trim is the fraction cut from each end).
+    Channels are on channel_axis, the last one by default like everywhere else in the pipeline.
+    """
+    ratios = get_channel_ratios(im_array, linearized, channel_axis)
+    coefs = robust_mean(ratios, method, trim, axis=0)
+    return coefs / np.sum(coefs)
+
+
+def get_unmixing_coefs_ci(im_array, linearized=False, method='mean', trim=0.1, n_bootstrap=1000, confidence=0.95,
+                          seed=None, channel_axis=-1):
+    #bootstrap confidence interval (low, high) of every coefficient from get_unmixing_coefs
+    #all the resamples are drawn and combined at once
+    ratios = get_channel_ratios(im_array, linearized, channel_axis)
+    rng = np.random.default_rng(seed)
+    samples = rng.integers(0, len(ratios), size=(n_bootstrap, len(ratios)))
+    coefs = robust_mean(ratios[samples], method, trim, axis=1)
+    coefs /= np.sum(coefs, axis=1, keepdims=True)
+    alpha = (1 - confidence) / 2
+    low, high = np.quantile(coefs, [alpha, 1 - alpha], axis=0)
+    return low, high
+
+
+def get_channel_ratios(im_array, linearized=False, channel_axis=-1):
+    #every channel divided by the reference channel, averaged per reference value: a values x channels table
+    im_array = np.asarray(im_array)
+    #flatten to pixels x channels
+    pixels_x_channels = np.moveaxis(im_array, channel_axis, -1).reshape(-1, im_array.shape[channel_axis])
+    if linearized:
+        low, high = cfg.range_min, cfg.range_max
+    else:
+        low, high = cfg.min_lin_val, cfg.max_lin_val
+
+    #find the channel with the highest mean, the others are measured relative to it
+    reference = np.argmax(pixels_x_channels.mean(axis=0))
+    xs = pixels_x_channels[:, reference]
+    #mask out all the invalid values: the reference has to be in the window and no channel past it (still linear)
+    valid = (xs > low) & (pixels_x_channels.max(axis=1) < high)
+    xs = xs[valid]
+    if np.issubdtype(xs.dtype, np.floating):
+        #linearized values are not integers, group them to the same precision the curves are corrected to
+        xs = np.round(xs, cfg.resolution)
+    unique_xs, inverse, counts = get_groups(xs)
+    if len(unique_xs) < cfg.min_points_for_valid_unmixing:
+        raise (
+            ValueError(
+                f"Unable to find enough valid points for unmixing. Found only {len(unique_xs)} values between {low} and {high}"
+            )
+        )
+
+    #we should now have an array that is X values by channels, divide it by the x value
+    ratios = np.empty((len(unique_xs), pixels_x_channels.shape[1]))
+    for channel in range(pixels_x_channels.shape[1]):
+        means = np.bincount(inverse, weights=pixels_x_channels[valid, channel], minlength=len(unique_xs)) / counts
+        ratios[:, channel] = means / unique_xs
+    return ratios
+
+
+def robust_mean(values, method='mean', trim=0.1, axis=0):
+    #'mean', 'median' or 'trimmed_mean' (trim is the fraction of values cut from each end) along axis
+    if method == 'mean':
+        return np.mean(values, axis=axis)
+    if method == 'median':
+        return np.median(values, axis=axis)
+    if method == 'trimmed_mean':
+        n = values.shape[axis]
+        cut = int(trim * n)
+        if 2 * cut >= n:
+            raise (ValueError(f"Trimming {trim} from each end leaves none of the {n} values"))
+        values = np.sort(values, axis=axis)
+        return np.mean(np.take(values, np.arange(cut, n - cut), axis=axis), axis=axis)
+    raise (ValueError(f"Unknown method {method}, use 'mean', 'median' or 'trimmed_mean'"))
+
+
+def get_robust_unmixing_ratio(xs_in, ys_in, method='median', trim=0.1, n_bootstrap=1000, confidence=0.95,
+                              seed=None):
+    """xs per y like get_unmixing_ratio, with a robust estimate and a bootstrap confidence interval.
+
+    The pixels (or a reduce_to_means table) are grouped once, and the same fallbacks as get_unmixing_ratio (relaxed
+    y bounds, then the window on y instead of x) are masks on that table rather than new scans.
+    'median' is the median slope through the origin (Theil-Sen without an intercept), 'trimmed_mean' the trimmed mean
+    of the slopes and 'mean' the ratio of the mean normalized pairs, as get_unmixing_ratio computes it.
+    Returns xs_per_y, (low, high) and the normalized pairs used.
+    """
+    xs, ys = get_ratio_pairs(xs_in, ys_in)
+    rng = np.random.default_rng(seed)
+    samples = rng.integers(0, len(xs), size=(n_bootstrap, len(xs)))
+    if method == 'mean':
+        xs_per_y = np.mean(xs) / np.mean(ys)
+        bootstrap = np.mean(xs[samples], axis=1) / np.mean(ys[samples], axis=1)
+    else:
+        slopes = xs / ys
+        xs_per_y = robust_mean(slopes, method, trim)
+        bootstrap = robust_mean(slopes[samples], method, trim, axis=1)
+    alpha = (1 - confidence) / 2
+    low, high = np.quantile(bootstrap, [alpha, 1 - alpha])
+    return xs_per_y, (low, high), (xs, ys)
+
+
+def get_ratio_pairs(xs_in, ys_in):
+    #the normalized pairs get_unmixing_ratio would use, from a single grouping of the data
+    unique_xs, _, mean_ys, _ = group_by_x(xs_in, ys_in)
+    not_nan = ~np.isnan(mean_ys)
+    x_in_window = (unique_xs > cfg.min_lin_val) & (unique_xs < cfg.max_lin_val) & not_nan
+    y_in_bounds = (mean_ys <= cfg.max_lin_val) & (mean_ys >= cfg.min_lin_val)
+    y_in_window = (mean_ys > cfg.min_lin_val) & (mean_ys < cfg.max_lin_val) & not_nan
+    for valid in (x_in_window & y_in_bounds, x_in_window, y_in_window):
+        if np.sum(valid) >= cfg.min_points_for_valid_unmixing:
+            break
+    else:
+        raise (
+            ValueError(
+                f"Unable to find enough valid points for unmixing. Found only xs:{unique_xs[valid]}, ys:{mean_ys[valid]}"
+            )
+        )
+    xs = unique_xs[valid]
+    ys = mean_ys[valid]
+    length = np.hypot(xs, ys)
+    return xs / length, ys / length
 
 
 def get_unmixing_ratio(xs_in, ys_in):
@@ -116,6 +263,53 @@ def get_unmixing_ratio(xs_in, ys_in):
     return xs, ys, xs_per_y
 
 
+def tune_linear_range(chanX, chanY, min_vals=None, max_vals=None):
+    #tune_linear_range_from_groups on the pixels of two channels
+    unique_xs, _, mean_ys, _ = group_by_x(chanX, chanY)
+    return tune_linear_range_from_groups(unique_xs, mean_ys, min_vals, max_vals)
+
+
+def tune_linear_range_from_groups(unique_xs, mean_ys, min_vals=None, max_vals=None):
+    """Pick min_lin_val and max_lin_val for the unmixing ratio from every candidate window at once.
+
+    unique_xs and mean_ys are the grouped table (group_by_x, reduce_to_means or calibration.group_histogram_by_x).
+    Each window keeps the pairs get_valid_pairs would keep and is scored by the variance of its mean slope (the spread of
+    the slopes over the number of points), which grows both with noise (window too low) and nonlinearity (too high).
+    Windows with fewer than cfg.min_points_for_valid_unmixing points are not considered.
+    Returns (min_lin_val, max_lin_val) and a dict of every candidate: min/max values, points, xs_per_y and variance.
+    """
+    if min_vals is None:
+        min_vals = np.arange(1, 40)
+    if max_vals is None:
+        max_vals = np.arange(10, 100)
+    lows, highs = np.meshgrid(min_vals, max_vals, indexing='ij')
+    lows, highs = lows.ravel(), highs.ravel()
+    keep = lows < highs
+    lows, highs = lows[keep], highs[keep]
+
+    valid_pairs = ~np.isnan(mean_ys)
+    xs = unique_xs[valid_pairs].astype(np.float64)
+    ys = mean_ys[valid_pairs]
+    # windows x points, the same conditions as get_valid_pairs(override_bounds=False)
+    low, high = lows[:, np.newaxis], highs[:, np.newaxis]
+    masks = ((xs > low) & (xs < high) & (ys >= low) & (ys <= high)).astype(np.float64)
+
+    length = np.hypot(xs, ys)
+    slopes = xs / ys
+    points = masks.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        xs_per_y = (masks @ (xs / length)) / (masks @ (ys / length))
+        mean_slope = masks @ slopes / points
+        variance = (masks @ slopes**2 / points - mean_slope**2) / points
+    variance[points < cfg.min_points_for_valid_unmixing] = np.inf
+    if not np.isfinite(variance).any():
+        raise (ValueError(f"No candidate window has {cfg.min_points_for_valid_unmixing} valid points for unmixing"))
+    best = np.argmin(variance)
+    candidates = {'min_lin_val': lows, 'max_lin_val': highs, 'points': points, 'xs_per_y': xs_per_y,
+                  'variance': variance}
+    return (lows[best].item(), highs[best].item()), candidates
+
+
 def switch_channels(chanX, chanY, xs_per_y):
     print("switching axis")
     xs_per_y = 1 / xs_per_y
@@ -123,13 +317,45 @@ def switch_channels(chanX, chanY, xs_per_y):
 
 
 def reduce_to_means(chanX, chanY):
-    ordered_xs = []
-    mean_ys = []
-    for x in np.unique(chanX):
-        ordered_xs.append(x)
-        y = np.mean(chanY[chanX == x])
-        mean_ys.append(y)
-    return np.array(ordered_xs), np.array(mean_ys)
+    ordered_xs, _, mean_ys, _ = group_by_x(chanX, chanY)
+    return ordered_xs, mean_ys
+
+
+def group_by_x(xs, ys):
+    """Group the ys by their x value in a single pass.
+
+    Returns the sorted unique xs and, for each of them, the number of pixels, the mean y and the variance of y."""
+    ys = np.ravel(ys)
+    unique_xs, inverse, counts = get_groups(xs)
+    means = np.bincount(inverse, weights=ys, minlength=len(unique_xs)) / counts
+    # two passes rather than E[y^2] - E[y]^2 so large, tightly spread values don't cancel out
+    variances = np.bincount(inverse, weights=(ys - means[inverse]) ** 2, minlength=len(unique_xs)) / counts
+    return unique_xs, counts, means, variances
+
+
+def get_groups(xs):
+    #the sorted unique xs, the group (index into unique_xs) of every x and the size of each group
+    #integer xs with a compact range are binned directly with bincount, anything else goes through np.unique
+    xs = np.ravel(xs)
+    if xs.dtype.kind in 'iub' and len(xs):
+        x_min = int(xs.min())
+        x_range = int(xs.max()) - x_min + 1
+    else:
+        x_range = None
+
+    if x_range is not None and x_range <= min(_max_lookup_keys, 4 * len(xs)):
+        groups = xs.astype(np.intp) - x_min
+        counts = np.bincount(groups, minlength=x_range)
+        present = np.flatnonzero(counts)
+        unique_xs = (present + x_min).astype(xs.dtype)
+        counts = counts[present]
+        lookup = np.zeros(x_range, dtype=np.intp)
+        lookup[present] = np.arange(len(present))
+        inverse = lookup[groups]
+    else:
+        unique_xs, inverse, counts = np.unique(xs, return_inverse=True, return_counts=True)
+        inverse = inverse.reshape(-1)
+    return unique_xs, inverse, counts
 
 
 def polyfit(x, y):
@@ -154,45 +380,53 @@ def smooth(y, box_pts_in):
 
 def compute_PMT_nonlinearity(chanX, chanY, xs_per_y):
 
-    # now loop through and count the number of photons
-    detected_photons = [0]
-    true_photons = [0]
-
     # the code is designed so that x stays linear longer, otherwise it won't work. If this is not the case we just switch
     # the mapping output is a property of the PMTs, and will be applied to each channel seperately so this is fine
     if np.median(chanY) > np.median(chanX):
         chanX, chanY, xs_per_y = switch_channels(chanX, chanY, xs_per_y)
 
-    for x in np.unique(chanX):
-        if x < cfg.max_lin_val / 2:
-            # if x is in the linear range, then no correction needs to be computed.
-            detected_photons.append(x)
-            true_photons.append(x)
-        else:
-            y = chanY[chanX == x][
-                0
-            ]  # was taking the mean here, but now do all means in "reduce to means"
-            if y > x:
-                print(
-                    "Warning, the mean seems to have crossed back over - there will be regions where the curve is invalid"
-                )
-                # x, y, xs_per_y = switch_channels(x, y, xs_per_y)
-                # raise(AssertionEror("Switching axis didn't work. You shouldn't hit this code, perhaps the pixel counts are non-monotonic?"))
-                # assert(x>y)
-            elif y > cfg.max_lin_val:
-                # if the y value is out of the linear range then we need to correct that first
-                # find the
-                y = correct_PMT_nonlinearity(
-                    np.array([y]), np.array(detected_photons), np.array(true_photons)
-                )
-                assert len(y) == 1
-                y = y[0]
-
-            expected_x = xs_per_y * y
-            detected_photons.append(x)
-            true_photons.append(expected_x)
-            # print(f'{x}, {y}: {expected_x}')
-    return np.array(detected_photons), np.array(true_photons)
+    # one pass over the pixels: every x value (sorted) and the first y seen with it
+    # (was taking the mean here, but now do all means in "reduce to means")
+    unique_xs, first_idxs = np.unique(chanX, return_index=True)
+    first_ys = chanY[first_idxs]
+
+    # now go through the compact table and count the number of photons, starting from 0,0
+    detected_photons = np.zeros(len(unique_xs) + 1, dtype=np.result_type(unique_xs.dtype, np.int64))
+    detected_photons[1:] = unique_xs
+    true_photons = np.zeros(len(unique_xs) + 1)
+
+    # if x is in the linear range, then no correction needs to be computed. xs are sorted so that's the start of the table
+    num_linear = np.searchsorted(unique_xs, cfg.max_lin_val / 2, side='left')
+    true_photons[1:num_linear+1] = unique_xs[:num_linear]
+
+    # each correction depends on the curve computed so far, so this part stays sequential (but only touches the table)
+    for n in range(num_linear+1, len(detected_photons)):
+        x = detected_photons[n]
+        y = first_ys[n-1]
+        if y > x:
+            print(
+                "Warning, the mean seems to have crossed back over - there will be regions where the curve is invalid"
+            )
+        elif y > cfg.max_lin_val:
+            # if the y value is out of the linear range then we need to correct that first
+            y = _correct_single_value(y, detected_photons[:n], true_photons[:n])
+        true_photons[n] = xs_per_y * y
+
+    if num_linear + 1 == len(detected_photons):
+        true_photons = true_photons.astype(detected_photons.dtype)
+    return detected_photons, true_photons
+
+
+def _correct_single_value(photons_measured, detected_photons_list, true_photons_list):
+    #correct_PMT_nonlinearity for one value, without copying the curve (it is called once per point while the curve
+    #is being built). Same checks and the same arithmetic, so the same answer to the last bit
+    if photons_measured >= np.max(detected_photons_list) or photons_measured < 0:
+        raise (ValueError("1 measured pixels are not in the correctable range of photons"))
+    idx = np.searchsorted(detected_photons_list, photons_measured) - 1
+    x_diff = detected_photons_list[idx + 1] - detected_photons_list[idx]
+    frac = (photons_measured - detected_photons_list[idx]) / (x_diff)
+    y_diff = true_photons_list[idx + 1] - true_photons_list[idx]
+    return true_photons_list[idx] + frac * y_diff
 
 
 def correct_PMT_nonlinearity(
@@ -244,26 +478,35 @@ def correct_PMT_nonlinearity(
     return y
 
 
-def get_average_curve(curve_dict):
-
-
+def get_average_curve(curve_dict, xs=None):
     #Taking the average of these curves is actually a bit tricky since they all have different X coordinates
-    xs = np.arange(0,300,1)
-    curve_sum = np.zeros(300)
-    count=0
+    #so every curve is resampled onto the same grid first
+    if xs is None:
+        xs = np.arange(0, cfg.average_curve_max, cfg.average_curve_step)
+    xs = np.asarray(xs)
+    curve_sum = np.zeros(len(xs))
+    count = 0
     for key, curve in curve_dict.items():
-        detected = curve['counts']
-        true_photons= curve['corrections']
+        #copies, since correct_PMT_nonlinearity sets the first point of the curve to 0,0 in place
+        detected = np.array(curve['counts'], dtype=np.float64)
+        true_photons = np.array(curve['corrections'], dtype=np.float64)
         #in order to get the correct curve back, we actually need to invert the conversion function
         #by having it correct true photons to detected_photons
         curve_sum += correct_PMT_nonlinearity(xs, true_photons, detected)
         count += 1
+    if count == 0:
+        raise (ValueError("No curves to average"))
     mean_curve = curve_sum/count
     return {'corrections': xs, 'counts': mean_curve}
 
 
-def linearize_image(im):
-    counts, corrections = io.load_master_PMT_curve()
+def linearize_image(im, counts=None, corrections=None, dtype=np.float64):
+    #integer images can be corrected with a lookup table of every possible pixel value, see build_linearization_lut
+    if counts is None:
+        counts, corrections = io.load_master_PMT_curve()
+    if lut_indexable(im.dtype):
+        lut = get_linearization_lut(counts, corrections, im.dtype, dtype=dtype)
+        return apply_linearization_lut(im, lut)
     lin_im = correct_PMT_nonlinearity(
                                 im,
                                 counts,
@@ -272,10 +515,90 @@ def linearize_image(im):
     return lin_im
 
 
+def lut_indexable(image_dtype):
+    image_dtype = np.dtype(image_dtype)
+    return np.issubdtype(image_dtype, np.integer) and image_dtype.itemsize <= 2
+
+
+def _lut_index_dtype(image_dtype):
+    #the unsigned integer type with the same bits, so an image can be used directly as indices into the lookup table
+    return np.dtype(f'u{np.dtype(image_dtype).itemsize}')
+
+
+def build_linearization_lut(counts, corrections, image_dtype=np.int16, dtype=np.float64, extrapolate=False):
+    """Correct every value an integer image can hold in one go.
+
+    The table is indexed by the raw bits of the pixel value (image.view(unsigned)), so for int16 images entry k
+    holds the correction of k for k < 2**15 and of k - 2**16 above that. Values outside the correctable range are
+    np.inf, like correct_PMT_nonlinearity(..., override=True), unless extrapolate is True. Then values past the end of
+    the curve use a cubic fit to it, and negative values (below the curve, where the PMT is linear) are left as they are.
+    """
+    index_dtype = _lut_index_dtype(image_dtype)
+    values = np.arange(np.iinfo(index_dtype).max + 1, dtype=index_dtype).view(image_dtype).astype(np.float64)
+    lut = np.full(values.shape, np.inf, dtype=dtype)
+    # correct_PMT_nonlinearity overwrites the first point of the curve, so give it copies
+    counts = np.array(counts, dtype=float)
+    corrections = np.array(corrections, dtype=float)
+    valid = np.logical_and(values >= 0, values < np.max(counts))
+    lut[valid] = correct_PMT_nonlinearity(values[valid], counts, corrections)
+    if extrapolate:
+        past_curve = values >= np.max(counts)
+        lut[past_curve] = np.polyval(polyfit(counts, corrections), values[past_curve])
+        lut[values < 0] = values[values < 0]
+    return lut
+
+
+_lut_cache = {}
+
+
+def get_linearization_lut(counts, corrections, image_dtype=np.int16, dtype=np.float64, extrapolate=False):
+    #building a table is ~65k interpolations, keep them around for the next image with the same curve
+    counts = np.asarray(counts)
+    corrections = np.asarray(corrections)
+    key = (counts.tobytes(), corrections.tobytes(), np.dtype(image_dtype).str, np.dtype(dtype).str, extrapolate)
+    if key not in _lut_cache:
+        _lut_cache[key] = build_linearization_lut(counts, corrections, image_dtype=image_dtype, dtype=dtype,
+                                                  extrapolate=extrapolate)
+    return _lut_cache[key]
+
+
+def get_max_corrected_value(counts, corrections, dtype=np.float64):
+    #the largest value linearization produces from this curve: every whole count below the end of the curve, corrected
+    #this is what 'max' fills uncorrectable pixels with, so integer and float images get the same value
+    lut = get_linearization_lut(counts, corrections, np.uint16, dtype=dtype)
+    return np.max(lut[np.isfinite(lut)])
+
+
+def apply_linearization_lut(im, luts, out=None):
+    #luts is a single lookup table for every channel or a list with one per channel (the last axis of im)
+    indices = im.view(_lut_index_dtype(im.dtype))
+    if isinstance(luts, np.ndarray):
+        return np.take(luts, indices, out=out, mode='clip')
+    if out is None:
+        out = np.empty(im.shape, dtype=luts[0].dtype)
+    for channel, lut in enumerate(luts):
+        np.take(lut, indices[..., channel], out=out[..., channel], mode='clip')
+    return out
+
+
+def handle_uncorrectable_pixels(lin_im, past_correctible_range, max_values=None):
+    #linearization marks values past the end of the PMT curve as np.inf. In place, for every channel of those pixels:
+    #'zero': set to 0
+    #'max': set to max_values (one per channel, the largest corrected value) so they're obvious in the output
+    invalid = ~np.isfinite(lin_im[..., 0])
+    for channel in range(1, lin_im.shape[-1]):
+        invalid |= ~np.isfinite(lin_im[..., channel])
+    if past_correctible_range == 'zero':
+        lin_im[invalid] = 0
+    elif past_correctible_range == 'max':
+        lin_im[invalid] = max_values
+    return lin_im
+
+
 def mock_unmixing(A, x_known, verbose=False):
     # Compute the detected flourescence amounts
     b = np.dot(A, x_known)
-    b, x_inferred, res = unmix(A, b, verbose)
+    x_inferred, res = unmix(A, b, verbose=verbose, compute_residuals=True)
     if verbose:
         print(f"Actual flourophore amounts = {x_known}")
     return b, x_inferred, res
@@ -289,7 +612,61 @@ def test_unmixing_mat(A, verbose=False):
     assert C>=N, f"The number of flourophores ({N})must be less than or equal to the number of channels ({C})"
 
 
-def unmix(A, b, nonnegative=False, verbose=False):
+def compute_unmixing_operator(A, verbose=False):
+    #The pseudo-inverse only depends on the unmixing matrix, so compute it once and reuse it for every image
+    #x = pinv(A) @ b is the same least squares solution np.linalg.lstsq finds, without refactorizing A each call
+    test_unmixing_mat(A, verbose=verbose)
+    return np.linalg.pinv(A)
+
+
+def apply_unmixing_operator(operator, b, dtype=None):
+    #b is channel-last, so we can flatten to pixels x channels without moving any axis (no copy for contiguous images)
+    #dtype is the precision the product is computed in, by default that of the operator
+    C_op = operator.shape[1]
+    C_im = b.shape[-1]
+    assert C_op == C_im, f"The number of channels in the image and the unmixing operator must be the same. Image channels = {C_im}, Operator channels = {C_op}"
+    if dtype is None:
+        dtype = operator.dtype
+    pixels_x_channels = b.reshape(-1, C_im).astype(dtype, copy=False)
+    x_inferred = pixels_x_channels @ operator.T.astype(dtype, copy=False)
+    return x_inferred.reshape(b.shape[:-1] + (operator.shape[0],))
+
+
+def unmix(A, b, nonnegative=False, verbose=False, operator=None, nnls_method='batched', nnls_operators=None,
+          compute_residuals=False, residual_dtype=np.float32, dtype=np.float64, deduplicate=False,
+          saturation_value=None, saturation_operators=None, background_threshold=None, foreground=None,
+          saturation_patterns=None):
+    #returns the unmixed image (as dtype) and, if compute_residuals, a map of the residual norm ||b - Ax|| for each pixel
+    #(the same shape as the image without the channel axis). Otherwise residuals are never computed and None is returned
+    #deduplicate solves each distinct pixel vector once, which pays off when there are far fewer of them than pixels (NNLS)
+    #channels at or above saturation_value are left out of the fit for that pixel, see unmix_saturation_aware
+    #saturation_patterns (from get_saturation_patterns on the raw image, shaped like b without the channel axis) is used
+    #instead of comparing b to saturation_value, for when b has already been linearized
+    #pixels outside the foreground mask (or at/below background_threshold in every channel) are set to 0 without solving
+    if foreground is None and background_threshold is not None:
+        foreground = get_foreground_mask(b, background_threshold)
+    if foreground is not None:
+        return unmix_foreground(A, b, foreground, nonnegative=nonnegative, verbose=verbose, operator=operator,
+                                nnls_method=nnls_method, nnls_operators=nnls_operators,
+                                compute_residuals=compute_residuals, residual_dtype=residual_dtype, dtype=dtype,
+                                deduplicate=deduplicate, saturation_value=saturation_value,
+                                saturation_operators=saturation_operators, saturation_patterns=saturation_patterns)
+    if deduplicate:
+        return unmix_unique_pixels(A, b, nonnegative=nonnegative, verbose=verbose, operator=operator,
+                                   nnls_method=nnls_method, nnls_operators=nnls_operators,
+                                   compute_residuals=compute_residuals, residual_dtype=residual_dtype, dtype=dtype,
+                                   saturation_value=saturation_value, saturation_operators=saturation_operators,
+                                   saturation_patterns=saturation_patterns)
+    if saturation_value is not None or saturation_patterns is not None:
+        return unmix_saturation_aware(A, b, saturation_value, nonnegative=nonnegative, verbose=verbose,
+                                      operator=operator, nnls_method=nnls_method, nnls_operators=nnls_operators,
+                                      compute_residuals=compute_residuals, residual_dtype=residual_dtype, dtype=dtype,
+                                      saturation_operators=saturation_operators,
+                                      saturation_patterns=saturation_patterns)
+    if operator is not None and not nonnegative:
+        return unmix_with_operator(A, b, operator, verbose=verbose,
+                                   compute_residuals=compute_residuals, residual_dtype=residual_dtype, dtype=dtype)
+
     test_unmixing_mat(A, verbose=verbose)
     C_mat = A.shape[0]
     C_im = b.shape[-1]
@@ -297,37 +674,473 @@ def unmix(A, b, nonnegative=False, verbose=False):
 
     #have to flatten and then reshape b - np.linalg.lstsq only works for 1 and 2 d arrays
     reorder_axis = np.moveaxis(b, -1, 0)
-    total_pixels = np.prod(np.array(reorder_axis.shape[1:]))
+    total_pixels = int(np.prod(reorder_axis.shape[1:]))
 
     channels_x_pixels = reorder_axis.reshape(C_im, total_pixels)
 
     # Compute the inferred flourophore amounts
 
-    if nonnegative:
-        #only positive values - MUCH slower. Consider using numba and implementing yourself if we do this a lot?
-        x_inferred = np.empty(channels_x_pixels.shape)
-        res = np.empty(channels_x_pixels.shape[1])
+    if nonnegative and nnls_method == 'scipy':
+        #only positive values - MUCH slower, one solver call per pixel. Kept for checking the batched solver
+        x_inferred = np.empty((A.shape[1], channels_x_pixels.shape[1]), dtype=dtype)
+        res = np.empty(channels_x_pixels.shape[1]) if compute_residuals else None
         for i in range(channels_x_pixels.shape[1]):
             x, r = nnls(A, channels_x_pixels[:,i])
             x_inferred[:,i] = x
-            res[i] = r
+            if compute_residuals:
+                res[i] = r
+    elif nonnegative:
+        x_inferred, res = batched_nnls(A, channels_x_pixels, operators=nnls_operators, compute_residuals=compute_residuals,
+                                       dtype=dtype)
     else:
-        x_inferred, res, rank, s = np.linalg.lstsq(A, channels_x_pixels)
+        x_inferred = np.linalg.lstsq(A, channels_x_pixels)[0]
+        # lstsq only gives the squared residuals when A is full rank and overdetermined, so compute them directly
+        res = np.sqrt(_sum_of_squares(channels_x_pixels - A @ x_inferred)) if compute_residuals else None
+        x_inferred = x_inferred.astype(dtype, copy=False)
 
     if verbose:
         min_val = np.min(x_inferred)
         if min_val<-10:
             logging.warning(f'Some large negative pixel intensities were computed, as low as {min_val}. This may indicate an error in imaging or the coefficient matrix')
 
-    unmixed_reorder_axis = np.reshape(x_inferred, reorder_axis.shape)
+    unmixed_reorder_axis = np.reshape(x_inferred, (x_inferred.shape[0],) + reorder_axis.shape[1:])
     unmixed = np.moveaxis(unmixed_reorder_axis, 0, -1)
 
+    if compute_residuals:
+        res = res.astype(residual_dtype).reshape(b.shape[:-1])
     return unmixed, res
 
 
-def original_spline_smoothing(image):
+def get_foreground_mask(b, background_threshold):
+    #True wherever any channel is above the threshold. Column by column is much faster than .any(axis=-1)
+    foreground = b[..., 0] > background_threshold
+    for channel in range(1, b.shape[-1]):
+        foreground |= b[..., channel] > background_threshold
+    return foreground
+
+
+def unmix_foreground(A, b, foreground, compute_residuals=False, residual_dtype=np.float32, dtype=np.float64,
+                     verbose=False, saturation_patterns=None, **unmix_kwargs):
+    #only solve the foreground pixels, gathered into a compact array. Background pixels are unmixed to 0
+    C_im = b.shape[-1]
+    N = A.shape[1]
+    pixels_x_channels = b.reshape(-1, C_im)
+    foreground_pixels = np.flatnonzero(foreground)
+    if verbose:
+        print(f'Unmixing {len(foreground_pixels)} foreground pixels out of {pixels_x_channels.shape[0]}')
+
+    if saturation_patterns is not None:
+        saturation_patterns = saturation_patterns.reshape(-1)[foreground_pixels]
+    unmixed = np.zeros((pixels_x_channels.shape[0], N), dtype=dtype)
+    unmixed[foreground_pixels], foreground_res = unmix(A, pixels_x_channels[foreground_pixels], verbose=verbose,
+                                                       compute_residuals=compute_residuals,
+                                                       residual_dtype=residual_dtype, dtype=dtype,
+                                                       saturation_patterns=saturation_patterns, **unmix_kwargs)
+    unmixed = unmixed.reshape(b.shape[:-1] + (N,))
+    if not compute_residuals:
+        return unmixed, None
+
+    # with nothing unmixed the residual is just the length of the pixel vector
+    background = b[~foreground].astype(residual_dtype).T
+    res = np.empty(pixels_x_channels.shape[0], dtype=residual_dtype)
+    res[foreground_pixels] = foreground_res
+    res[~foreground.reshape(-1)] = np.sqrt(_sum_of_squares(background))
+    return unmixed, res.reshape(b.shape[:-1])
+
+
+# largest packed pixel key range we will map with a lookup table instead of sorting with np.unique
+_max_lookup_keys = 2**26
+
+
+def find_unique_pixels(pixels_x_channels):
+    """Find the distinct channel vectors in a pixels x channels array.
+
+    Returns the unique pixels (unique x channels) and the index of each pixel's row in the unique array,
+    so unique_pixels[inverse] gives back the original pixels.
+    Integer images are packed into a single integer key per pixel which is much faster than np.unique(axis=0).
+    """
+    if len(pixels_x_channels) == 0:
+        # e.g. a chunk with no foreground pixels
+        return pixels_x_channels, np.zeros(0, dtype=np.intp)
+    if not np.issubdtype(pixels_x_channels.dtype, np.integer):
+        unique_pixels, inverse = np.unique(pixels_x_channels, axis=0, return_inverse=True)
+        return unique_pixels, inverse.reshape(-1)
+
+    mins = pixels_x_channels.min(axis=0).astype(np.int64)
+    ranges = pixels_x_channels.max(axis=0).astype(np.int64) - mins + 1
+    if np.prod(ranges.astype(float)) >= 2**62:
+        unique_pixels, inverse = np.unique(pixels_x_channels, axis=0, return_inverse=True)
+        return unique_pixels, inverse.reshape(-1)
+
+    # key = sum of (value - min) * stride, with strides like the index into an array of shape ranges
+    strides = np.cumprod(np.concatenate(([1], ranges[:0:-1])))[::-1]
+    keys = np.zeros(pixels_x_channels.shape[0], dtype=np.int64)
+    for channel, stride in enumerate(strides):
+        keys += (pixels_x_channels[:, channel].astype(np.int64) - mins[channel]) * stride
+
+    total_keys = int(np.prod(ranges))
+    if total_keys <= min(_max_lookup_keys, 4 * len(keys)):
+        # no sorting needed - mark which keys are present and number them
+        present = np.bincount(keys, minlength=total_keys) > 0
+        unique_keys = np.flatnonzero(present)
+        key_to_index = np.cumsum(present) - 1
+        inverse = key_to_index[keys]
+    else:
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+
+    unique_pixels = np.empty((len(unique_keys), len(strides)), dtype=pixels_x_channels.dtype)
+    remainder = unique_keys
+    for channel, stride in enumerate(strides):
+        unique_pixels[:, channel] = remainder // stride + mins[channel]
+        remainder = remainder % stride
+    return unique_pixels, inverse.reshape(-1)
+
+
+def unmix_unique_pixels(A, b, verbose=False, compute_residuals=False, saturation_patterns=None, **unmix_kwargs):
+    #unmix each distinct channel vector once, then scatter the results back out to every pixel that had it
+    #with saturation_patterns, the pattern is part of what makes a pixel distinct
+    C_im = b.shape[-1]
+    pixels_x_channels = b.reshape(-1, C_im)
+    if saturation_patterns is not None:
+        pixels_x_channels = np.hstack((pixels_x_channels, saturation_patterns.reshape(-1, 1)))
+    unique_pixels, inverse = find_unique_pixels(pixels_x_channels)
+    if saturation_patterns is not None:
+        saturation_patterns = unique_pixels[:, -1].astype(np.int64)
+        unique_pixels = unique_pixels[:, :-1]
+    if verbose:
+        print(f'Unmixing {len(unique_pixels)} unique pixel values out of {len(inverse)} pixels')
+    unmixed_unique, res_unique = unmix(A, unique_pixels, verbose=verbose, compute_residuals=compute_residuals,
+                                       saturation_patterns=saturation_patterns, **unmix_kwargs)
+    unmixed = unmixed_unique[inverse].reshape(b.shape[:-1] + (unmixed_unique.shape[-1],))
+    res = res_unique[inverse].reshape(b.shape[:-1]) if compute_residuals else None
+    return unmixed, res
+
+
+def get_saturation_patterns(pixels_x_channels, saturation_value):
+    #one integer per pixel with bit c set if channel c is saturated
+    patterns = np.zeros(pixels_x_channels.shape[0], dtype=np.int64)
+    for channel in range(pixels_x_channels.shape[1]):
+        patterns |= (pixels_x_channels[:, channel] >= saturation_value).astype(np.int64) << channel
+    return patterns
+
+
+def get_saturated_pixels(pixels_x_channels, saturation_value):
+    #indices of the pixels with any saturated channel. Column by column is much faster than .any(axis=1)
+    saturated = pixels_x_channels[:, 0] >= saturation_value
+    for channel in range(1, pixels_x_channels.shape[1]):
+        saturated |= pixels_x_channels[:, channel] >= saturation_value
+    return np.flatnonzero(saturated)
+
+
+def get_valid_channels(pattern, num_channels):
+    return np.array([not (pattern >> channel) & 1 for channel in range(num_channels)])
+
+
+def _get_saturation_operators(saturation_operators, pattern, A_valid, nonnegative):
+    key = (int(pattern), nonnegative)
+    if key not in saturation_operators:
+        if nonnegative:
+            saturation_operators[key] = compute_nnls_operators(A_valid)
+        else:
+            saturation_operators[key] = compute_unmixing_operator(A_valid)
+    if nonnegative:
+        return None, saturation_operators[key]
+    return saturation_operators[key], None
+
+
+def unmix_saturation_aware(A, b, saturation_value, nonnegative=False, verbose=False, operator=None,
+                           nnls_operators=None, compute_residuals=False, residual_dtype=np.float32,
+                           dtype=np.float64, saturation_operators=None, saturation_patterns=None, **unmix_kwargs):
+    """Unmix, leaving saturated channels out of the fit for each pixel.
+
+    A saturated channel only tells us the real value is somewhere above the PMT ceiling, so including it biases
+    every flourophore estimate. Pixels are grouped by which channels are saturated and each group is solved with the
+    rows of A for its unsaturated channels. Operators for each pattern are cached in saturation_operators (a dict)
+    if one is passed in. Patterns that leave fewer channels than flourophores can't be solved, so those pixels
+    fall back to using every channel.
+    Saturation is read from b unless saturation_patterns (one per pixel, from the raw image) is given.
+    """
+    C, N = A.shape
+    C_im = b.shape[-1]
+    pixels_x_channels = b.reshape(-1, C_im)
+    if saturation_patterns is None:
+        saturated_pixels = get_saturated_pixels(pixels_x_channels, saturation_value)
+        patterns = get_saturation_patterns(pixels_x_channels[saturated_pixels], saturation_value)
+    else:
+        saturation_patterns = saturation_patterns.reshape(-1)
+        saturated_pixels = np.flatnonzero(saturation_patterns)
+        patterns = saturation_patterns[saturated_pixels]
+    if saturation_operators is None:
+        saturation_operators = {}
+
+    # most pixels aren't saturated, so solve everything the normal way and then redo only the saturated groups
+    unmixed, res = unmix(A, pixels_x_channels, nonnegative=nonnegative, verbose=verbose, operator=operator,
+                         nnls_operators=nnls_operators, compute_residuals=compute_residuals,
+                         residual_dtype=residual_dtype, dtype=dtype, **unmix_kwargs)
+    pattern_counts = np.bincount(patterns, minlength=2**C)
+    for pattern in np.flatnonzero(pattern_counts[1:]) + 1:
+        valid_channels = get_valid_channels(pattern, C)
+        if valid_channels.sum() < N:
+            if verbose:
+                logging.warning(f'{pattern_counts[pattern]} pixels have fewer unsaturated channels than flourophores, using all channels for them')
+            continue
+        group = saturated_pixels[patterns == pattern]
+        A_valid = A[valid_channels]
+        group_operator, group_nnls_operators = _get_saturation_operators(saturation_operators, pattern, A_valid,
+                                                                         nonnegative)
+        unmixed[group], group_res = unmix(A_valid, pixels_x_channels[group][:, valid_channels],
+                                          nonnegative=nonnegative, verbose=False,
+                                          operator=group_operator, nnls_operators=group_nnls_operators,
+                                          compute_residuals=compute_residuals, residual_dtype=residual_dtype,
+                                          dtype=dtype, **unmix_kwargs)
+        if compute_residuals:
+            res[group] = group_res
+
+    unmixed = unmixed.reshape(b.shape[:-1] + (N,))
+    if compute_residuals:
+        res = res.reshape(b.shape[:-1])
+    return unmixed, res
+
+
+def compute_nnls_operators(A):
+    #The non-negative solution is the least squares solution restricted to whichever flourophores are non-zero.
+    #With only a handful of flourophores we can just precompute the pseudo-inverse for every subset (2^N - 1 of them)
+    test_unmixing_mat(A)
+    C, N = A.shape
+    operators = []
+    for subset_size in range(1, N+1):
+        for subset in itertools.combinations(range(N), subset_size):
+            subset = np.array(subset)
+            operators.append((subset, np.linalg.pinv(A[:, subset])))
+    return operators
+
+
+def _sum_of_squares(channels_x_pixels):
+    #row by row is much faster than np.sum(axis=0) when there are only a few channels
+    total = channels_x_pixels[0] * channels_x_pixels[0]
+    for row in channels_x_pixels[1:]:
+        total += row * row
+    return total
+
+
+def batched_nnls(A, channels_x_pixels, operators=None, block_size=2**14, compute_residuals=True, dtype=np.float64):
+    """Solve min ||Ax - b|| subject to x >= 0 for every pixel at once.
+
+    The NNLS solution is the least squares solution on some support (set of non-zero flourophores), and it is the one
+    that is non-negative and where no flourophore left out could lower the residual (the KKT conditions). Most pixels
+    are non-negative with every flourophore, so the full support is solved first; the other pixels are checked against
+    each support in turn. Everything works on A^T b and A^T A (flourophores, not channels), and the few pixels that
+    rounding leaves undecided get the best feasible candidate by residual instead. Same answer as scipy.optimize.nnls.
+    Returns the flourophores x pixels solution and the residual norm for each pixel, like nnls does
+    (or None for the residuals if compute_residuals is False).
+    """
+    if operators is None:
+        operators = compute_nnls_operators(A)
+    N = A.shape[1]
+    total_pixels = channels_x_pixels.shape[1]
+    x_inferred = np.zeros((N, total_pixels), dtype=dtype)
+    res = np.empty(total_pixels, dtype=dtype) if compute_residuals else None
+    A = A.astype(dtype, copy=False)
+    operators = [(subset, subset_operator.astype(dtype, copy=False)) for subset, subset_operator in operators]
+    gram = A.T @ A
+    # x on a support S is inv(A_S^T A_S) (A^T b)_S, and pinv(A_S) pinv(A_S)^T is that inverse
+    supports = [(subset, np.setdiff1d(np.arange(N), subset), subset_operator @ subset_operator.T)
+                for subset, subset_operator in operators]
+    # operators are ordered by subset size, so the last one is every flourophore
+    full_inverse = supports[-1][2]
+    partial_supports = supports[:-1]
+
+    for start in range(0, total_pixels, block_size):
+        stop = min(start + block_size, total_pixels)
+        block = channels_x_pixels[:, start:stop].astype(dtype)
+        correlations = A.T @ block
+        x_block = x_inferred[:, start:stop]
+        # non-negative with every flourophore is already the NNLS optimum
+        x_block[...] = full_inverse @ correlations
+        solved = _all_rows(x_block >= 0)
+        x_block *= solved
+
+        unsolved = _nnls_kkt(x_block, correlations, gram, partial_supports, solved)
+        unsolved = np.flatnonzero(unsolved)
+        if len(unsolved):
+            x_block[:, unsolved] = _nnls_over_supports(A, block[:, unsolved], operators, dtype)
+
+        if compute_residuals:
+            res[start:stop] = np.sqrt(_sum_of_squares(block - A @ x_block))
+
+    return x_inferred, res
+
+
+def _all_rows(conditions):
+    #np.all(axis=0), row by row since that is much faster with only a few rows
+    result = conditions[0].copy()
+    for row in conditions[1:]:
+        result &= row
+    return result
+
+
+def _nnls_kkt(x, correlations, gram, supports, solved):
+    #fill in x (in place) for the pixels not yet solved whose optimal support is among supports (or empty)
+    #returns the mask of pixels where no support passed the checks (rounding right at a boundary)
+    tolerance = 1e-9 * np.maximum.reduce(np.abs(correlations))
+    # the empty support: adding any flourophore would only increase the residual. x is already 0 there
+    solved = solved | _all_rows(correlations <= tolerance)
+    for subset, complement, subset_inverse in supports:
+        x_subset = subset_inverse @ correlations[subset]
+        ok = ~solved
+        for row in x_subset:
+            ok &= row >= 0
+        # how much each left out flourophore would lower the residual, has to be <= 0
+        for flourophore in complement:
+            ok &= correlations[flourophore] - gram[flourophore, subset] @ x_subset <= tolerance
+        for row, flourophore in enumerate(subset):
+            np.copyto(x[flourophore], x_subset[row], where=ok)
+        solved |= ok
+    return ~solved
+
+
+def _nnls_over_supports(A, block, operators, dtype):
+    #the best feasible solution over the given supports and the empty one, by residual
+    x_block = np.zeros((A.shape[1], block.shape[1]), dtype=dtype)
+    # the empty support (all flourophores = 0) is always feasible
+    best_res = _sum_of_squares(block)
+    for subset, subset_operator in operators:
+        x_subset = subset_operator @ block
+        subset_res = _sum_of_squares(block - A[:, subset] @ x_subset)
+        better = np.logical_and(np.min(x_subset, axis=0) >= 0, subset_res < best_res)
+        np.copyto(best_res, subset_res, where=better)
+        x_block *= ~better
+        for row, flourophore in enumerate(subset):
+            np.copyto(x_block[flourophore], x_subset[row], where=better)
+    return x_block
+
+
+def unmix_with_operator(A, b, operator, verbose=False, compute_residuals=False, residual_dtype=np.float32, dtype=np.float64):
+    C_mat, N = A.shape
+    C_im = b.shape[-1]
+    assert C_mat == C_im, f"The number of channels in the image and the unmixing matrix must be the same. Image channels = {C_im}, Unmixing channels = {C_mat}"
+
+    unmixed = apply_unmixing_operator(operator, b, dtype=dtype)
+
+    if verbose:
+        min_val = np.min(unmixed)
+        if min_val<-10:
+            logging.warning(f'Some large negative pixel intensities were computed, as low as {min_val}. This may indicate an error in imaging or the coefficient matrix')
+
+    if compute_residuals:
+        pixels_x_channels = b.reshape(-1, C_im)
+        residual_vectors = pixels_x_channels - unmixed.reshape(-1, N) @ A.T.astype(dtype)
+        res = np.sqrt(np.einsum('ij,ij->i', residual_vectors, residual_vectors))
+        res = res.astype(residual_dtype).reshape(b.shape[:-1])
+    else:
+        res = None
+
+    return unmixed, res
+
+
+def fused_unmix(image, operator, luts=None, past_correctible_range=None, max_values=None, zero_negatives=True,
+                quantize=False, dtype=np.float32, block_pixels=2**14, use_numba=True):
+    """Linearize (lookup table), unmix (operator), zero negatives and optionally round to uint16 in one pass.
+
+    The stages are run block by block of pixels, so the intermediates stay in cache instead of each stage writing a full
+    size image. luts is one lookup table per channel (or None to skip linearization, integer images only), with
+    past_correctible_range and max_values as in handle_uncorrectable_pixels. quantize returns uint16 the same as
+    io.to_uint16, otherwise the result is dtype. Uses numba when it is installed, and the NumPy version otherwise.
+    """
+    C = image.shape[-1]
+    N = operator.shape[0]
+    pixels_x_channels = image.reshape(-1, C)
+    if luts is not None:
+        pixels_x_channels = pixels_x_channels.view(_lut_index_dtype(image.dtype))
+        luts = np.stack([np.asarray(lut, dtype=dtype) for lut in luts])
+    out = np.empty((pixels_x_channels.shape[0], N), dtype=np.uint16 if quantize else dtype)
+    operator_T = np.ascontiguousarray(operator.T, dtype=dtype)
+    if max_values is None:
+        max_values = np.zeros(C)
+    max_values = np.broadcast_to(np.asarray(max_values, dtype=dtype), (C,)).copy()
+    invalid_mode = {'zero': 1, 'max': 2}.get(past_correctible_range, 0)
+
+    if use_numba and numba is not None:
+        if luts is None:
+            #the identity, so both versions take the same arguments
+            luts = np.zeros((C, 0), dtype=dtype)
+        _fused_unmix_numba(pixels_x_channels, luts, luts.shape[1] > 0, operator_T, invalid_mode, max_values,
+                           zero_negatives, quantize, block_pixels, out)
+    else:
+        _fused_unmix_numpy(pixels_x_channels, luts, operator_T, invalid_mode, max_values, zero_negatives, quantize,
+                           block_pixels, dtype, out)
+    return out.reshape(image.shape[:-1] + (N,))
+
+
+def _fused_unmix_numpy(pixels_x_channels, luts, operator_T, invalid_mode, max_values, zero_negatives, quantize,
+                       block_pixels, dtype, out):
+    C = pixels_x_channels.shape[1]
+    #one set of block sized buffers reused for every block
+    lin_block = np.empty((block_pixels, C), dtype=dtype)
+    unmixed_block = np.empty((block_pixels, operator_T.shape[1]), dtype=dtype)
+    for start in range(0, pixels_x_channels.shape[0], block_pixels):
+        block = pixels_x_channels[start:start + block_pixels]
+        n = block.shape[0]
+        lin = lin_block[:n]
+        unmixed = unmixed_block[:n]
+        if luts is None:
+            lin[...] = block
+        else:
+            for channel in range(C):
+                np.take(luts[channel], block[:, channel], out=lin[:, channel], mode='clip')
+            if invalid_mode:
+                invalid = ~np.isfinite(lin).all(axis=1)
+                if invalid.any():
+                    lin[invalid] = 0 if invalid_mode == 1 else max_values
+        np.matmul(lin, operator_T, out=unmixed)
+        if zero_negatives:
+            np.maximum(unmixed, 0, out=unmixed)
+        if quantize:
+            np.rint(unmixed, out=unmixed)
+            np.clip(unmixed, 0, np.iinfo(np.uint16).max, out=unmixed)
+        out[start:start + n] = unmixed
+
+
+if numba is not None:
+    # single threaded: parallel=True starts numba's threading layer, and a process pool forked after that (NNLS in
+    # process_image_parallel, calibrate_images) hangs at exit. Chunks are the unit of parallel work anyway
+    @numba.njit(cache=True)
+    def _fused_unmix_numba(pixels_x_channels, luts, linearize, operator_T, invalid_mode, max_values, zero_negatives,
+                           quantize, block_pixels, out):
+        P, C = pixels_x_channels.shape
+        N = operator_T.shape[1]
+        num_blocks = (P + block_pixels - 1) // block_pixels
+        for b in range(num_blocks):
+            lin = np.empty(C, dtype=operator_T.dtype)
+            for p in range(b * block_pixels, min(P, (b + 1) * block_pixels)):
+                valid = True
+                for c in range(C):
+                    if linearize:
+                        idx = min(int(pixels_x_channels[p, c]), luts.shape[1] - 1)
+                        lin[c] = luts[c, idx]
+                        valid = valid and np.isfinite(lin[c])
+                    else:
+                        lin[c] = pixels_x_channels[p, c]
+                if not valid and invalid_mode != 0:
+                    for c in range(C):
+                        lin[c] = 0 if invalid_mode == 1 else max_values[c]
+                for n in range(N):
+                    value = lin[0] * operator_T[0, n]
+                    for c in range(1, C):
+                        value += lin[c] * operator_T[c, n]
+                    if zero_negatives and value < 0:
+                        value = 0
+                    if quantize:
+                        value = min(max(np.rint(value), 0), 65535)
+                    out[p, n] = value
+else:
+    _fused_unmix_numba = None
+
+
+def original_spline_smoothing(image, dtype=np.float64):
     """This is the original smoothing algorithm copied from the version
     of the unmixing algorithm that only works on Matlab 2018...
+    The result is computed and returned as dtype (correlate keeps the input dtype, which would truncate integer images)
     """
 
     spline_filter = np.array([[[[0.0039,    0.0156,    0.0234,    0.0156,    0.0039],
@@ -342,9 +1155,82 @@ def original_spline_smoothing(image):
      #y_sm = imfilter(y,h);
      #see https://stackoverflow.com/questions/22142369/the-equivalent-function-of-matlab-imfilter-in-python
 
-    new_image = scipy.ndimage.correlate(image, spline_filter, mode='constant')
+    new_image = scipy.ndimage.correlate(image.astype(dtype, copy=False), spline_filter.astype(dtype), mode='constant')
 
     return new_image
 
 
+# original_spline_smoothing's filter is symmetric, so it only has 3 distinct rows (the outer two, the next two and the
+# middle one). Summing the image rows those apply to first (Y) leaves 3 1D filters along X: the same weights on the same
+# pixels as the 2D filter, just added up in a different order
+spline_filter_rows = np.array([[0.0039, 0.0156, 0.0234, 0.0156, 0.0039],
+                               [0.0156, 0.0625, 0.0938, 0.0625, 0.0156],
+                               [0.0234, 0.0938, 0.1406, 0.0938, 0.0234]])
+
+
+def separable_spline_smoothing(image, dtype=np.float32, num_workers=1):
+    """The same smoothing as original_spline_smoothing, one (Z plane, channel) at a time: the Y neighbours that share a
+    filter row are added up, then 3 1D filters run along X. num_workers threads work on different (plane, channel)
+    pairs so even a single plane is split between them.
+
+    Sums are in float64 like scipy.ndimage and the weights are rounded to dtype like original_spline_smoothing does, so
+    float32 results are the same values (only the order of the additions differs, which can at most change the last
+    bit of a float64 result). Uses numba when it is installed, and scipy 1D filters otherwise.
+    """
+    image = image.astype(dtype, copy=False)
+    weights = spline_filter_rows.astype(dtype).astype(np.float64)
+    new_image = np.empty(image.shape, dtype=dtype)
+    # ZYXC, or ZYX with a single channel
+    slices = [(z, ..., c) for z in range(image.shape[0]) for c in range(image.shape[3])] if image.ndim == 4 \
+        else [(z,) for z in range(image.shape[0])]
+
+    def smooth_slice(index):
+        # one YX plane, copied to be contiguous, with zeros outside like the original
+        plane = np.ascontiguousarray(image[index])
+        smoothed = np.empty(plane.shape, dtype=dtype)
+        if numba is not None:
+            _spline_smooth_plane_numba(plane, weights, smoothed)
+        else:
+            _spline_smooth_plane(plane, weights, smoothed)
+        new_image[index] = smoothed
+
+    if num_workers == 1:
+        for index in slices:
+            smooth_slice(index)
+    else:
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            list(executor.map(smooth_slice, slices))
+    return new_image
+
 
+def _spline_smooth_plane(plane, weights, out):
+    padded = np.zeros((plane.shape[0] + 4, plane.shape[1]))
+    padded[2:-2] = plane
+    # rows 2 apart, rows 1 apart and the row itself
+    row_sums = [padded[:-4] + padded[4:], padded[1:-3] + padded[3:-1], padded[2:-2]]
+    smoothed = np.zeros(plane.shape)
+    for row_sum, row_weights in zip(row_sums, weights):
+        smoothed += scipy.ndimage.correlate1d(row_sum, row_weights, axis=1, mode='constant')
+    out[...] = smoothed
+
+
+if numba is not None:
+    @numba.njit(cache=True, nogil=True)
+    def _spline_smooth_plane_numba(plane, weights, out):
+        Y, X = plane.shape
+        # the 3 row sums of the current row, with 2 zeros of padding on either side
+        row_sums = np.zeros((3, X + 4))
+        for y in range(Y):
+            for x in range(X):
+                row_sums[0, x + 2] = (plane[y - 2, x] if y >= 2 else 0.0) + (plane[y + 2, x] if y + 2 < Y else 0.0)
+                row_sums[1, x + 2] = (plane[y - 1, x] if y >= 1 else 0.0) + (plane[y + 1, x] if y + 1 < Y else 0.0)
+                row_sums[2, x + 2] = plane[y, x]
+            for x in range(X):
+                value = 0.0
+                for i in range(3):
+                    value += (weights[i, 0] * (row_sums[i, x] + row_sums[i, x + 4])
+                              + weights[i, 1] * (row_sums[i, x + 1] + row_sums[i, x + 3])
+                              + weights[i, 2] * row_sums[i, x + 2])
+                out[y, x] = value
+else:
+    _spline_smooth_plane_numba = None
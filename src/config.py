@@ -30,6 +30,8 @@ valid_curve_json_filename = 'valid_curves.json'
 master_PMT_curve_corrections_suffix = "_mean_2022_08_08_16_16_.npy"
 
 #can't remember what this was for... I think maybe you need the counts before using the mean??
+#photon_counts file of each channel, paired with the master photon_corrections (see io.load_channel_PMT_curves).
+#channels not listed here (ch3 with num_channels = 4) fall back to the master curve with a warning
 channel_counts = {
                     'ch0': "_ch1_2022_08_08_16_16_.npy",
                     'ch1': "_ch1_2022_08_08_16_16_.npy",
@@ -45,6 +47,15 @@ range_max = 250
 
 save_array_as = 'csv' #csv or npy
 
+#calibration histograms (see calibration.py) have one bin per pixel value up to this, brighter pixels share the last bin
+#(with a warning)
+#memory is calibration_max_value**2 counts per channel pair
+calibration_max_value = 1024
+
+#photon counts the PMT curves are resampled onto when averaging them (get_average_curve)
+average_curve_max = 300
+average_curve_step = 1
+
 
 #unmixing_mat = np.array(
 #        [[1, 0, 0],
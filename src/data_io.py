@@ -78,12 +78,70 @@ def load_PMT_curves():
 
 
 def load_master_PMT_curve():
+    return load_PMT_curve(cfg.master_PMT_curve_corrections_suffix)
+
+
+def load_PMT_curve(suffix):
+    #curves are kept in memory after the first read (see _load_PMT_curve_cached), so linearizing many stacks
+    #doesn't parse the same files over and over. Copies are returned so callers are free to modify them
     subdir = os.path.join(*cfg.results_path)
-    counts_path = os.path.join(subdir, f'photon_counts{cfg.master_PMT_curve_corrections_suffix}')
-    corrections_path = os.path.join(subdir, f'photon_corrections{cfg.master_PMT_curve_corrections_suffix}')
-    counts = load_array(counts_path)
-    corrections = load_array(corrections_path)
-    return counts, corrections
+    counts_path = os.path.join(subdir, f'photon_counts{suffix}')
+    corrections_path = os.path.join(subdir, f'photon_corrections{suffix}')
+    counts, corrections = _load_PMT_curve_cached(counts_path, corrections_path)
+    return counts.copy(), corrections.copy()
+
+
+_PMT_curve_cache = {}
+
+
+def _load_PMT_curve_cached(counts_path, corrections_path):
+    #keyed by path and modification time, so a curve that is saved again gets re-read
+    key = (os.path.abspath(counts_path), _mtime(counts_path),
+           os.path.abspath(corrections_path), _mtime(corrections_path))
+    if key not in _PMT_curve_cache:
+        _PMT_curve_cache[key] = (load_array(counts_path), load_array(corrections_path))
+    return _PMT_curve_cache[key]
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        #let load_array raise the usual error for a missing file
+        return None
+
+
+def load_channel_PMT_curves(num_channels, channel_suffixes=None):
+    #one (counts, corrections) curve per channel. cfg.channel_counts ({'ch0': suffix, ...}) names the photon_counts file
+    #of each channel, and they are all measured on the photon_corrections grid of the master curve
+    #channels without their own counts (e.g. channel 3 with the default 4 channels) use the master curve
+    if channel_suffixes is None:
+        channel_suffixes = cfg.channel_counts
+    _, master_corrections = load_master_PMT_curve()
+    curves = []
+    for channel in range(num_channels):
+        suffix = channel_suffixes.get(f'ch{channel}')
+        if suffix is None:
+            logging.warning(f'No PMT curve given for channel {channel}, using the master curve')
+            suffix = cfg.master_PMT_curve_corrections_suffix
+        counts = load_PMT_counts(suffix)
+        if len(counts) != len(master_corrections):
+            raise (ValueError(f'photon_counts{suffix} has {len(counts)} values but the master corrections have '
+                              f'{len(master_corrections)}'))
+        curves.append((counts, master_corrections.copy()))
+    return curves
+
+
+def load_PMT_counts(suffix):
+    counts_path = os.path.join(*cfg.results_path, f'photon_counts{suffix}')
+    return _load_PMT_counts_cached(counts_path).copy()
+
+
+def _load_PMT_counts_cached(counts_path):
+    key = (os.path.abspath(counts_path), _mtime(counts_path))
+    if key not in _PMT_curve_cache:
+        _PMT_curve_cache[key] = load_array(counts_path)
+    return _PMT_curve_cache[key]
 
 
 def savefig(fig, filename):
@@ -186,6 +244,111 @@ def get_tiff_stack(folder_path, num_channels):
     return np.array(slice_list), None
 
 
+def get_stack_shape(fullpath, num_channels=None):
+    #shape of one volume of the stack as ZYXC without reading the pixel data, so we can plan chunks and set up the writer
+    #time series have get_num_timepoints(fullpath) of these volumes
+    if num_channels is None:
+        num_channels = cfg.num_channels
+    if '.tif' in fullpath:
+        shape = _get_tiff_axes_sizes(fullpath)
+        channels = shape.get('C', shape.get('S', 1))
+        return (shape.get('Z', 1), shape['Y'], shape['X'], channels)
+    file_list = get_ordered_I16_list(fullpath)
+    first_plane = I16_read(os.path.join(fullpath, file_list[0]), num_channels)
+    return (len(file_list),) + first_plane.shape
+
+
+def get_num_timepoints(fullpath):
+    #only tiffs can hold a time series (TZCYX), I16 folders are always a single volume
+    if '.tif' in fullpath:
+        return _get_tiff_axes_sizes(fullpath).get('T', 1)
+    return 1
+
+
+def _get_tiff_axes_sizes(fullpath):
+    with tf.TiffFile(fullpath) as tif:
+        series = tif.series[0]
+        return dict(zip(_get_tiff_axes(series, fullpath), series.shape))
+
+
+def _get_tiff_axes(series, fullpath):
+    #tiffs without ImageJ metadata (e.g. a plain tf.imwrite) call the plane axis Q (or I), read that as Z
+    #raise rather than guess when that still leaves axes we can't place, the data would be scrambled otherwise
+    axes = series.axes
+    if axes[0] in 'QI' and axes.count(axes[0]) == 1 and 'Z' not in axes:
+        axes = 'Z' + axes[1:]
+    sizes = dict(zip(axes, series.shape))
+    unknown = [axis for axis, size in zip(axes, series.shape) if axis not in 'TZCSYX' and size > 1]
+    if unknown or len(set(axes)) != len(axes) or (sizes.get('C', 1) > 1 and sizes.get('S', 1) > 1):
+        raise (ValueError(f"Can't tell the Z and channel axes of {fullpath} (tiff axes {series.axes}, shape "
+                          f"{series.shape}), save it with ImageJ metadata, e.g. imagej=True, metadata={{'axes': 'ZCYX'}}"))
+    return axes
+
+
+def iter_stack_chunks(fullpath, planes_per_chunk, num_channels=None):
+    #yield the stack as ZYXC chunks of at most planes_per_chunk Z planes, only reading each chunk from disk as it is needed
+    #for time series the chunks of each timepoint follow each other, and a chunk never spans two timepoints
+    if num_channels is None:
+        num_channels = cfg.num_channels
+    if '.tif' in fullpath:
+        yield from _iter_tiff_chunks(fullpath, planes_per_chunk)
+        return
+    file_list = get_ordered_I16_list(fullpath)
+    for start in range(0, len(file_list), planes_per_chunk):
+        slice_list = [I16_read(os.path.join(fullpath, file_name), num_channels)
+                      for file_name in file_list[start:start+planes_per_chunk]]
+        yield np.array(slice_list)
+
+
+def _pages_in_order(axes):
+    #True if each tiff page is one YX(S) image and the pages are ordered by T, then Z, then C
+    page_axes = axes.replace('S', '')
+    if not page_axes.endswith('YX') or len(set(page_axes)) != len(page_axes):
+        return False
+    order = ['TZCYX'.find(axis) for axis in page_axes]
+    return -1 not in order and order == sorted(order) and axes.find('S') in (-1, len(axes)-1)
+
+
+def _iter_tiff_chunks(fullpath, planes_per_chunk):
+    with tf.TiffFile(fullpath) as tif:
+        series = tif.series[0]
+        axes = _get_tiff_axes(series, fullpath)
+        if _pages_in_order(axes):
+            shape = dict(zip(axes, series.shape))
+            num_timepoints = shape.get('T', 1)
+            num_planes = shape.get('Z', 1)
+            pages_per_plane = shape.get('C', 1)
+            for timepoint in range(num_timepoints):
+                first_page = timepoint * num_planes * pages_per_plane
+                for start in range(0, num_planes, planes_per_chunk):
+                    stop = min(start + planes_per_chunk, num_planes)
+                    pages = range(first_page + start*pages_per_plane, first_page + stop*pages_per_plane)
+                    chunk = np.stack([tif.pages[i].asarray() for i in pages])
+                    if 'C' in axes:
+                        chunk = np.moveaxis(chunk.reshape((stop-start, pages_per_plane) + chunk.shape[1:]), 1, -1)
+                    elif 'S' not in axes:
+                        chunk = chunk[..., np.newaxis]
+                    yield chunk
+            return
+        #unusual axis orders - fall back to reading the whole file, and put it in TZYXC order
+        logging.warning(f'Unable to read {axes} tiffs in chunks, the whole stack will be loaded into memory')
+        image = series.asarray()
+    # drop the size 1 axes that aren't ours (_get_tiff_axes only allows those)
+    image = image.reshape([size for axis, size in zip(axes, image.shape) if axis in 'TZCSYX'])
+    axes = ''.join(axis for axis in axes if axis in 'TZCSYX')
+    channel_axis = 'C' if 'C' in axes else 'S'
+    image = np.transpose(image, [axes.index(axis) for axis in 'TZYX' + channel_axis if axis in axes])
+    if 'T' not in axes:
+        image = image[np.newaxis]
+    if 'Z' not in axes:
+        image = image[:, np.newaxis]
+    if channel_axis not in axes:
+        image = image[..., np.newaxis]
+    for volume in image:
+        for start in range(0, volume.shape[0], planes_per_chunk):
+            yield volume[start:start+planes_per_chunk]
+
+
 def get_ordered_I16_list(path_):
     ordered_file_list = []
 
@@ -227,17 +390,57 @@ def tiffify_filename(filename):
     return filename
 
 def write_composite_4d_tiff(image_stack: np.array , dirpath, filename, verbose=False, **kwargs, ):
+    #convert one Z plane at a time while writing rather than making a full uint16 copy of the stack
+    #5D TZYXC time series are written as TZCYX
+    all_planes = image_stack.reshape((-1,) + image_stack.shape[-3:])
+    planes = (all_planes[i:i+1] for i in range(all_planes.shape[0]))
+    write_composite_4d_tiff_chunked(planes, image_stack.shape, dirpath, filename, verbose=verbose, **kwargs)
+
+
+def to_uint16(chunk):
+    #clip and round into the uint16 range instead of letting astype wrap negatives around and truncate decimals
+    if chunk.dtype == np.uint16:
+        return chunk
+    if np.issubdtype(chunk.dtype, np.floating):
+        chunk = np.rint(chunk)
+        np.clip(chunk, 0, np.iinfo(np.uint16).max, out=chunk)
+    else:
+        chunk = np.clip(chunk, 0, np.iinfo(np.uint16).max)
+    return chunk.astype('uint16')
+
+
+def write_composite_4d_tiff_chunked(chunks, shape, dirpath, filename, verbose=False, **kwargs):
+    #like write_composite_4d_tiff, but the ZYXC chunks are written as they arrive so the full stack is never in memory
+    #shape is the ZYXC shape of the full stack, or TZYXC for a time series (the chunks of each timepoint in order)
     filename, extension = os.path.splitext(filename)
-    #filename = f"{filename}{'_composite'}"
     filename = tiffify_filename(filename)
     fullpath = os.path.join(dirpath, filename)
-    reorder_axis = np.moveaxis(image_stack, -1, 1)
+    *outer_shape, Y, X, C = shape
+    axes = 'TZCYX' if len(outer_shape) == 2 else 'ZCYX'
+
+    def pages():
+        for chunk in chunks:
+            for plane in chunk:
+                yield from np.moveaxis(to_uint16(plane), -1, 0)
+
     if verbose:
         print(f'Saving image to {fullpath}')
-    tf.imwrite(fullpath, reorder_axis.astype('uint16'), kwargs, metadata={'axes': 'ZCYX'}, imagej=True) # imagej=False)compression='LZW')#
+    tf.imwrite(fullpath, pages(), shape=(*outer_shape, C, Y, X), dtype='uint16', metadata={'axes': axes}, imagej=True, **kwargs)
     if verbose:
         print('Save complete')
 
+
+def create_residual_tiff(shape, dirpath, filename, dtype=np.float32, verbose=False):
+    #an empty ZYX (or TZYX) tiff on disk, returned as a memmap so residual maps can be filled in chunk by chunk
+    filename, extension = os.path.splitext(filename)
+    filename = tiffify_filename(filename)
+    fullpath = os.path.join(dirpath, filename)
+    if verbose:
+        print(f'Saving residuals to {fullpath}')
+    axes = 'TZYX'[-len(shape):]
+    return tf.memmap(fullpath, shape=shape, dtype=dtype, metadata={'axes': axes}, imagej=True)
+
+
 def write_color_seperated_4d_tiff(image_stack: np.array , dirpath, filename, **kwargs):
     filename, extension = os.path.splitext(filename)
     for i in range(image_stack.shape[0]):
@@ -299,13 +502,22 @@ def get_unmixing_mat(flourophore_list = None):
     return np.array(unmixing_mat)
 
 
-def umixing_app_save(cfg, image, new_image):
+def umixing_app_save(cfg, image, new_image, residuals=None):
     if cfg.save_original_tiff:
         new_filename = f"{cfg.filename}_original"
         write_composite_4d_tiff(image, cfg.save_path, new_filename, verbose=True, compression=cfg.compression,)
 
     if cfg.save_processed_tiff:
-        new_filename = f"{cfg.filename}{bool(cfg.linearize_PMTs)*'_linearized'}{bool(cfg.unmix)*'_unmixed'}{bool(cfg.smoothing)*'_smoothed'}"
+        new_filename = get_processed_filename(cfg)
         write_composite_4d_tiff(new_image, cfg.save_path, new_filename, verbose=True, compression=cfg.compression)
+        if residuals is not None:
+            residual_map = create_residual_tiff(residuals.shape, cfg.save_path, f"{new_filename}_residuals",
+                                                dtype=residuals.dtype, verbose=True)
+            residual_map[:] = residuals
+            residual_map.flush()
+
+
+def get_processed_filename(cfg):
+    return f"{cfg.filename}{bool(cfg.linearize_PMTs)*'_linearized'}{bool(cfg.unmix)*'_unmixed'}{bool(cfg.smoothing)*'_smoothed'}"
 
 
@@ -7,6 +7,10 @@ import numpy as np
 from matplotlib import pyplot as plt
 
 import os
+import logging
+import itertools
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
 
 def main_scatter_only(fp, i_number, j_number, channel_i, channel_j, alpha=0.01):
     # plot a scatter plot of the existing pixels
@@ -21,10 +25,11 @@ def main_scatter_only(fp, i_number, j_number, channel_i, channel_j, alpha=0.01):
         ordered_is, mean_js, i_number, j_number, alpha=1, label=fp, ax=ax, color="r"
     )
     io.savefig(fig, title)
+    return ordered_is, mean_js
 
 
 def main(fp, i_number, j_number, channel_i, channel_j, alpha=0.01):
-    main_scatter_only(fp, i_number, j_number, channel_i, channel_j, alpha)
+    ordered_is, mean_js = main_scatter_only(fp, i_number, j_number, channel_i, channel_j, alpha)
 
 
     # plot and save the unmixing ratio that will be used for this image and pair of channels
@@ -87,7 +92,26 @@ def main(fp, i_number, j_number, channel_i, channel_j, alpha=0.01):
 
 class UnmixingSession:
     def __init__(self):
-        pass
+        self.nnls_method = 'batched'  # 'batched' or 'scipy' (one solver call per pixel, very slow)
+        self.past_correctible_range = 'max'  # 'zero', 'max' or 'correct', see linearize_PMTs
+        self.channel_PMT_curves = None  # {'ch0': photon_counts file suffix, ...} for each channel. None for config.channel_counts
+        self.memory_budget_bytes = 2 * 1024**3  # working memory for all chunks in flight when processing with process_and_save_chunked
+        self.num_workers = 1  # Z chunks processed at the same time by process_image_parallel and process_and_save_chunked
+        self.compute_residuals = False  # also produce a map of the unmixing residual norm for every pixel
+        self.residual_dtype = np.float32
+        self.compute_dtype = np.float32  # precision used by every processing stage. float64 doubles memory use
+        self.deduplicate_pixels = False  # solve each distinct pixel value once. Much faster for NNLS on dim images
+        self.background_threshold = None  # pixels at or below this in every channel are unmixed to 0 without solving. None to solve every pixel
+        self.saturation_value = None  # raw pixel value at which a channel is saturated and left out of the fit. None to use every channel
+        self.smoothing_threads = 1  # threads used for smoothing each image (or chunk)
+        self.fuse_stages = False  # linearize, unmix and zero negatives in a single pass over the image, see plan_stages
+        self._unmixing_operator = None
+        self._unmixing_operator_key = None
+        self._nnls_operators = None
+        self._nnls_operators_key = None
+        self._saturation_operators = {}
+        self._saturation_operators_key = None
+        self._PMT_curves = None
 
     def my_init(self, verbose=False):
         supdir, filename = os.path.split(self.open_path)
@@ -108,32 +132,348 @@ class UnmixingSession:
             print(f'Number of channels = {self.num_channels}')
             print(f'Unmixing matrix = \n{self.unmixing_mat}')
 
+    def get_unmixing_operator(self, verbose=False):
+        #only refactorize if the unmixing matrix has actually changed since the last call,
+        #so batches of stacks unmixed with the same coefficients only pay for this once
+        key = self._unmixing_mat_key()
+        if self._unmixing_operator is None or key != self._unmixing_operator_key:
+            self._unmixing_operator = comp.compute_unmixing_operator(self.unmixing_mat, verbose=verbose)
+            self._unmixing_operator_key = key
+        return self._unmixing_operator
 
+    def get_nnls_operators(self):
+        key = self._unmixing_mat_key()
+        if self._nnls_operators is None or key != self._nnls_operators_key:
+            self._nnls_operators = comp.compute_nnls_operators(self.unmixing_mat)
+            self._nnls_operators_key = key
+        return self._nnls_operators
 
+    def get_saturation_operators(self):
+        #filled in by comp.unmix_saturation_aware as new saturation patterns show up
+        key = self._unmixing_mat_key()
+        if key != self._saturation_operators_key:
+            self._saturation_operators = {}
+            self._saturation_operators_key = key
+        return self._saturation_operators
 
+    def get_PMT_curves(self, num_channels):
+        #read each channel's curve from disk once per session
+        if self._PMT_curves is None or len(self._PMT_curves) != num_channels:
+            self._PMT_curves = io.load_channel_PMT_curves(num_channels, self.channel_PMT_curves)
+        return self._PMT_curves
 
-def process_image(cfg, image):
-    if cfg.linearize_PMTs:
-        print('Performing PMT linearlization')
-        #new_image = main.linearize_PMTs(image)
-        #Need to implement this ^^^
-        new_image = image
+    def get_linearization_luts(self, num_channels, image_dtype):
+        extrapolate = self.past_correctible_range == 'correct'
+        return [comp.get_linearization_lut(counts, corrections, image_dtype, dtype=self.compute_dtype,
+                                           extrapolate=extrapolate)
+                for counts, corrections in self.get_PMT_curves(num_channels)]
+
+    def _unmixing_mat_key(self):
+        unmixing_mat = np.asarray(self.unmixing_mat)
+        return (unmixing_mat.shape, unmixing_mat.tobytes())
+
+
+
+
+
+def handles_negatives(cfg, method):
+    return cfg.handle_negatives is not None and method in cfg.handle_negatives.lower()
+
+
+def linearize_PMTs(cfg, image):
+    """Correct each channel with its own PMT curve (see UnmixingSession.get_PMT_curves).
+
+    cfg.past_correctible_range decides what happens to pixels with a channel past the end of its curve:
+    zero: set the pixel value to zero in all channels
+    max: set the pixel values in all channels to the maximum corrected value, so it's obvious which pixels to ignore
+    correct: use the best fit curve to attempt to linearize them anyway
+    """
+    num_channels = image.shape[-1]
+    if comp.lut_indexable(image.dtype):
+        luts = cfg.get_linearization_luts(num_channels, image.dtype)
+        new_image = comp.apply_linearization_lut(image, luts)
     else:
-        new_image = image
+        new_image = np.empty(image.shape, dtype=cfg.compute_dtype)
+        for channel, (counts, corrections) in enumerate(cfg.get_PMT_curves(num_channels)):
+            new_image[..., channel] = comp.correct_PMT_nonlinearity(image[..., channel], np.array(counts, dtype=float),
+                                                                    np.array(corrections, dtype=float), override=True)
+        if cfg.past_correctible_range == 'correct':
+            logging.warning('Extrapolating past the PMT curve is only supported for integer images')
+    max_values = get_max_corrected_values(cfg, num_channels)
+    return comp.handle_uncorrectable_pixels(new_image, cfg.past_correctible_range, max_values)
+
+
+def get_max_corrected_values(cfg, num_channels):
+    #the 'max' fill value of each channel, the same whatever the image dtype
+    return [comp.get_max_corrected_value(counts, corrections, dtype=cfg.compute_dtype)
+            for counts, corrections in cfg.get_PMT_curves(num_channels)]
+
+
+def process_image(cfg, image, verbose=True):
+    plan = plan_stages(cfg, image)
+    if verbose:
+        print(f'Stage plan: {describe_plan(plan)}')
+
+    new_image = image
+    foreground = None
+    residuals = None
+    unmixed = False
+    # saturation is a property of the raw pixel values, so it is read before linearization changes them
+    saturation_patterns = None
+    if cfg.unmix and cfg.saturation_value is not None:
+        saturation_patterns = comp.get_saturation_patterns(image.reshape(-1, image.shape[-1]),
+                                                           cfg.saturation_value).reshape(image.shape[:-1])
+    for name, linear in plan:
+        if name == 'linearize':
+            if verbose:
+                print('Performing PMT linearlization')
+            new_image = linearize_PMTs(cfg, image)
+
+        elif name == 'find_foreground':
+            # computed once per image (or chunk) and shared by the stages that can skip background
+            foreground = comp.get_foreground_mask(new_image, cfg.background_threshold)
 
-    if cfg.unmix:
-        print('Performing unmixing')
-        nonnegative= 'non_negative_least_squares' in cfg.handle_negatives.lower()
-        new_image, residuals = comp.unmix(cfg.unmixing_mat, new_image, nonnegative = nonnegative, verbose=True)
-        if 'set_to_zero' in cfg.handle_negatives.lower():
+        elif name == 'fused_unmix':
+            if verbose:
+                print('Performing PMT linearlization and unmixing in one pass')
+            # without smoothing afterwards the output is also rounded to uint16 in that pass
+            new_image = fused_unmix(cfg, image, quantize=plan[-1][0] == 'fused_unmix')
+            unmixed = True
+
+        elif name == 'unmix':
+            if verbose:
+                print('Performing unmixing')
+            nonnegative = handles_negatives(cfg, 'non_negative_least_squares')
+            operator = None if nonnegative else cfg.get_unmixing_operator()
+            nnls_operators = cfg.get_nnls_operators() if nonnegative else None
+            new_image, residuals = comp.unmix(cfg.unmixing_mat, new_image, nonnegative = nonnegative, verbose=verbose,
+                                              operator=operator, nnls_method=cfg.nnls_method,
+                                              nnls_operators=nnls_operators, compute_residuals=cfg.compute_residuals,
+                                              residual_dtype=cfg.residual_dtype, dtype=cfg.compute_dtype,
+                                              deduplicate=cfg.deduplicate_pixels,
+                                              saturation_patterns=saturation_patterns,
+                                              saturation_operators=cfg.get_saturation_operators(),
+                                              foreground=foreground)
+            unmixed = True
+
+        elif name == 'set_to_zero':
             new_image[new_image<0]=0
-    else:
-        residuals = None
 
-    if cfg.smoothing:
-        print('Performing smoothing')
-        if 'original_spline_smoothing' in cfg.smoothing.lower():
-            new_image = comp.original_spline_smoothing(new_image)
+        elif name == 'smooth':
+            if verbose:
+                print('Performing smoothing')
+            smooth = get_smoothing_function(cfg)
+            if foreground is not None and unmixed:
+                new_image = smooth_foreground_planes(new_image, foreground, smooth, dtype=cfg.compute_dtype)
+            else:
+                new_image = smooth(new_image)
 
     return new_image, residuals
 
+
+def plan_stages(cfg, image):
+    """The stages process_image will run on image, in order, as (name, linear) pairs.
+
+    Smoothing comes last, after unmixing, which is also the order that smooths the fewest channels: the linear stages
+    commute, but comp.test_unmixing_mat requires at least as many channels as flourophores, so smoothing first would
+    never be cheaper and the stages aren't reordered.
+    With cfg.fuse_stages, linearization, unmixing and set_to_zero become one fused stage when comp.fused_unmix covers them.
+    """
+    stages = []
+    if cfg.fuse_stages and can_fuse_stages(cfg, image):
+        stages.append(('fused_unmix', False))
+    else:
+        if cfg.linearize_PMTs:
+            stages.append(('linearize', False))
+        if cfg.background_threshold is not None:
+            stages.append(('find_foreground', False))
+        if cfg.unmix:
+            stages.append(('unmix', unmixing_is_linear(cfg)))
+            if handles_negatives(cfg, 'set_to_zero'):
+                stages.append(('set_to_zero', False))
+    if get_smoothing_function(cfg) is not None:
+        stages.append(('smooth', True))
+    return stages
+
+
+def describe_plan(plan):
+    return ' -> '.join(f"{name}{' (linear)' if linear else ''}" for name, linear in plan) or 'nothing to do'
+
+
+def unmixing_is_linear(cfg):
+    #least squares with the operator is a matrix product per pixel. Anything that treats pixels differently is not
+    return (not handles_negatives(cfg, 'non_negative_least_squares') and cfg.saturation_value is None
+            and cfg.background_threshold is None and not cfg.compute_residuals)
+
+
+def can_fuse_stages(cfg, image):
+    #the fused kernel covers lookup table linearization and unmixing with the least squares operator, nothing else
+    return (cfg.unmix and not handles_negatives(cfg, 'non_negative_least_squares') and not cfg.compute_residuals
+            and cfg.saturation_value is None and cfg.background_threshold is None
+            and (not cfg.linearize_PMTs or comp.lut_indexable(image.dtype)))
+
+
+def fused_unmix(cfg, image, quantize=False):
+    #linearization, unmixing and setting negatives to zero block by block in one pass (comp.fused_unmix),
+    #same result as running them one after the other
+    luts, max_values = None, None
+    if cfg.linearize_PMTs:
+        luts = cfg.get_linearization_luts(image.shape[-1], image.dtype)
+        max_values = get_max_corrected_values(cfg, image.shape[-1])
+    return comp.fused_unmix(image, cfg.get_unmixing_operator(), luts=luts,
+                            past_correctible_range=cfg.past_correctible_range, max_values=max_values,
+                            zero_negatives=handles_negatives(cfg, 'set_to_zero'), quantize=quantize,
+                            dtype=cfg.compute_dtype)
+
+
+def get_smoothing_function(cfg):
+    #cfg.smoothing picks the filter, original_spline_smoothing is the 4 decimal B3-spline kernel of the Matlab version
+    #both names run comp.separable_spline_smoothing, which gives the same result much faster
+    #(separable_spline_smoothing is kept as a name for configs that already use it)
+    if not cfg.smoothing:
+        return None
+    if 'spline_smoothing' in cfg.smoothing.lower():
+        return partial(comp.separable_spline_smoothing, dtype=cfg.compute_dtype, num_workers=cfg.smoothing_threads)
+    return None
+
+
+def smooth_foreground_planes(image, foreground, smooth, dtype=np.float64):
+    #smoothing doesn't cross Z planes, so planes with no foreground at all are just left as zeros
+    #only valid after unmixing has zeroed the background. Any foreground pixel means the whole plane is smoothed,
+    #so this only saves time on stacks with completely dark planes
+    planes = np.flatnonzero(foreground.reshape(foreground.shape[0], -1).any(axis=1))
+    new_image = np.zeros(image.shape, dtype=dtype)
+    if len(planes):
+        new_image[planes] = smooth(image[planes])
+    return new_image
+
+
+# temporaries per pixel per channel (unmixing input, result, residuals and smoothing output), used to size chunks
+_working_values_per_value = 4
+
+
+def get_planes_per_chunk(cfg, shape, num_workers=1):
+    #every stage works on whole Z planes (the smoothing kernel doesn't cross planes), so chunk along Z
+    #the memory budget is shared by every chunk being worked on at once
+    Z, Y, X, C = shape
+    N = np.asarray(cfg.unmixing_mat).shape[1] if cfg.unmix else C
+    bytes_per_plane = Y * X * max(C, N) * _working_values_per_value * np.dtype(cfg.compute_dtype).itemsize
+    planes_in_budget = cfg.memory_budget_bytes // (bytes_per_plane * _chunks_in_flight(num_workers))
+    # but keep the chunks small enough that every worker gets at least one
+    planes_per_worker = -(-Z // num_workers)
+    return int(max(1, min(planes_in_budget, planes_per_worker)))
+
+
+def _chunks_in_flight(num_workers):
+    return 1 if num_workers == 1 else 2 * num_workers
+
+
+def get_output_shape(cfg, shape):
+    Z, Y, X, C = shape
+    N = np.asarray(cfg.unmixing_mat).shape[1] if cfg.unmix else C
+    return (Z, Y, X, N)
+
+
+def get_executor(cfg, num_workers):
+    #NNLS does a lot of small python level work per block, so it gets its own processes.
+    #Everything else is BLAS/ufunc work that releases the GIL, so threads avoid copying chunks between processes
+    if cfg.unmix and handles_negatives(cfg, 'non_negative_least_squares'):
+        return ProcessPoolExecutor(max_workers=num_workers)
+    return ThreadPoolExecutor(max_workers=num_workers)
+
+
+def _ordered_map(executor, function, iterable, max_pending):
+    #like executor.map, but only pulls max_pending items from iterable ahead of the results being consumed
+    #so streaming chunks from disk doesn't read the whole stack up front
+    iterator = iter(iterable)
+    pending = [executor.submit(function, item) for item in itertools.islice(iterator, max_pending)]
+    while pending:
+        result = pending.pop(0).result()
+        for item in itertools.islice(iterator, 1):
+            pending.append(executor.submit(function, item))
+        yield result
+
+
+def process_image_chunked(cfg, chunks, num_workers=1):
+    #run process_image one chunk at a time so only a few chunks (and their temporaries) are ever in memory
+    #chunks come back in the same order they went in, whatever the number of workers
+    process_chunk = partial(process_image, cfg, verbose=False)
+    if num_workers == 1:
+        yield from map(process_chunk, chunks)
+        return
+    with get_executor(cfg, num_workers) as executor:
+        yield from _ordered_map(executor, process_chunk, chunks, _chunks_in_flight(num_workers))
+
+
+def process_image_parallel(cfg, image, num_workers=None):
+    """Same as process_image, but the stack is split along Z and the chunks are processed by num_workers workers.
+
+    The output is identical to process_image since none of the stages mix Z planes.
+    """
+    if num_workers is None:
+        num_workers = cfg.num_workers
+    planes_per_chunk = get_planes_per_chunk(cfg, image.shape, num_workers=num_workers)
+    chunks = (image[start:start+planes_per_chunk] for start in range(0, image.shape[0], planes_per_chunk))
+
+    new_chunks = []
+    residual_chunks = []
+    for new_chunk, residuals in process_image_chunked(cfg, chunks, num_workers=num_workers):
+        new_chunks.append(new_chunk)
+        residual_chunks.append(residuals)
+    residuals = None if residual_chunks[0] is None else np.concatenate(residual_chunks)
+    return np.concatenate(new_chunks), residuals
+
+
+def process_and_save_chunked(cfg, verbose=True):
+    """Stream cfg.open_path through process_image and straight into the output tiff(s).
+
+    Stacks are read, processed and written a few Z planes at a time, sized so the working memory of the chunks
+    in flight stays under cfg.memory_budget_bytes, with cfg.num_workers chunks processed at once.
+    Time series (TZCYX tiffs) are processed one volume after another and saved as TZCYX tiffs.
+    Use this instead of imread/process_image/umixing_app_save for stacks that don't fit in memory.
+    """
+    shape = io.get_stack_shape(cfg.open_path, num_channels=cfg.num_channels)
+    num_timepoints = io.get_num_timepoints(cfg.open_path)
+    planes_per_chunk = get_planes_per_chunk(cfg, shape, num_workers=cfg.num_workers)
+    # one ZYXC volume per timepoint
+    outer_shape = (num_timepoints,) if num_timepoints > 1 else ()
+    if verbose:
+        print(f'The image is {shape[3]} channels, {shape[1]}x{shape[2]} pixels and {shape[0]} Z frames')
+        if num_timepoints > 1:
+            print(f'with {num_timepoints} timepoints')
+        print(f'Processing {planes_per_chunk} Z frames at a time')
+
+    if cfg.save_original_tiff:
+        chunks = io.iter_stack_chunks(cfg.open_path, planes_per_chunk, num_channels=cfg.num_channels)
+        io.write_composite_4d_tiff_chunked(chunks, outer_shape + shape, cfg.save_path, f"{cfg.filename}_original",
+                                           verbose=verbose, compression=cfg.compression)
+
+    if cfg.save_processed_tiff:
+        chunks = io.iter_stack_chunks(cfg.open_path, planes_per_chunk, num_channels=cfg.num_channels)
+        if verbose:
+            # chunks are processed quietly, so report the plan once here
+            first_chunk = next(chunks)
+            print(f'Stage plan: {describe_plan(plan_stages(cfg, first_chunk))}')
+            chunks = itertools.chain([first_chunk], chunks)
+        results = process_image_chunked(cfg, chunks, num_workers=cfg.num_workers)
+        if cfg.unmix and cfg.compute_residuals:
+            residual_map = io.create_residual_tiff(outer_shape + shape[:3], cfg.save_path,
+                                                   f"{io.get_processed_filename(cfg)}_residuals",
+                                                   dtype=cfg.residual_dtype, verbose=verbose)
+            results = _write_residual_chunks(results, residual_map)
+        new_chunks = (new_chunk for new_chunk, residuals in results)
+        io.write_composite_4d_tiff_chunked(new_chunks, outer_shape + get_output_shape(cfg, shape),
+                                           cfg.save_path, io.get_processed_filename(cfg),
+                                           verbose=verbose, compression=cfg.compression)
+
+
+def _write_residual_chunks(results, residual_map):
+    #write each chunk's residuals into the (memory mapped) residual tiff as the chunks go by to the image writer
+    #time series are filled in as one long run of Z planes
+    all_planes = residual_map.reshape((-1,) + residual_map.shape[-2:])
+    z = 0
+    for new_chunk, residuals in results:
+        all_planes[z:z+len(residuals)] = residuals
+        z += len(residuals)
+        yield new_chunk, residuals
+    residual_map.flush()
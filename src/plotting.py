@@ -101,6 +101,26 @@ def plot_spread(xs, ys, channel_i, channel_j, plot=True, ax=None):
     return fig, ax, title
 
 
+def plot_spread_from_histogram(spreads, channel_i, channel_j, plot=True, ax=None):
+    # plot_spread from the joint histogram of the two channels, spreads comes from calibration.get_spreads
+    fig, ax = new_ax(ax)
+    for x, bins, y in spreads:
+        ax.plot(bins[1:], y, label=f"Channel {channel_i}={x}")
+    ax.set_xlabel("Channel" + str(channel_j) + " pixels from mean")
+    ax.set_ylabel("Percentage of pixels")
+    title = (
+        "Spread around mean in Channel"
+        + str(channel_j)
+        + " for fixed Channel"
+        + str(channel_i)
+    )
+    ax.set_title(title)
+    ax.legend()
+    if plot:
+        plt.show()
+    return fig, ax, title
+
+
 def plot_PMT_curves(pmt_curves, plot=True, ax=None):
     fig, ax = new_ax(ax)
     photon_max = 0